@@ -1,35 +1,91 @@
-from typing import Annotated
+from typing import Annotated, Union
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from passlib.context import CryptContext
 from pydantic import BaseModel
-import secrets
+
+from .metrics import install_metrics, registry
+from .compression import install_compression
+from .log import get_logger
+from .journal_store import UsernameStore, UsernameTaken
+from .hashing import PasswordHasher, HasherBusy, hasher_busy_handler
+from .basic_credentials import BasicAuthVerifier, password_admin_router
+
+log = get_logger(__name__)
+
+password_hasher = PasswordHasher(CryptContext(schemes=['bcrypt'], deprecated='auto'))
 
 
 class User(BaseModel):
     username: str
-    password: str
+    password: str   # hashed, like the journals' passwords. it used to be kept (and compared) in plain text
     details: str
+    __users__: UsernameStore    # indexed by username. set up right below the class
+
+    @classmethod
+    async def add(cls, user: 'User'):
+        # raises UsernameTaken if the username is taken
+        if user.username in cls.__users__:
+            raise UsernameTaken(user.username)
+        user.password = await password_hasher.hash(user.password)
+        cls.__users__.add(user)
+
+    @classmethod
+    def get(cls, username: str) -> Union['User', None]:
+        return cls.__users__.get(username)
+
+    @classmethod
+    def update(cls, username: str, /, **changes) -> Union['User', None]:
+        return cls.__users__.update(username, **changes)
+
 
-    def get_username_bytes(self):
-        return self.username.encode('utf8')
+User.__users__ = UsernameStore()
 
-    def get_password_bytes(self):
-        return self.password.encode('utf8')
 
+def set_password(username: str, new_hash: str) -> User | None:
+    return User.update(username, password=new_hash)
 
-user = User(username='foo', password='bar', details='siri')
 
-app = FastAPI()
+# repeat requests with the same username and password skip bcrypt. see basic_credentials.py
+verifier = BasicAuthVerifier(password_hasher, User.get, set_password)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await password_hasher.calibrate()
+    if User.get('foo') is None:     # the user this app always had
+        await User.add(User(username='foo', password='bar', details='siri'))
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(HasherBusy, hasher_busy_handler)
+install_compression(app, 'basic_auth')
+install_metrics(app, 'basic_auth')
+registry.register_stats('basic_auth_cache', verifier.stats, {'app': 'basic_auth'})
+app.include_router(password_admin_router(verifier, set_password))
+registry.register_stats('password_hasher', password_hasher.stats, {'app': 'basic_auth'})
 security = HTTPBasic()
 
 
-@app.get('/user')
-def get_user(auth: Annotated[HTTPBasicCredentials, Depends(security)]):
-    username_match = secrets.compare_digest(auth.username.encode('utf8'), user.get_username_bytes())
-    password_match = secrets.compare_digest(auth.password.encode('utf8'), user.get_password_bytes())
+@app.post('/user', response_model_include={'username'})
+async def add_user(user: User) -> User:
+    try:
+        await User.add(user)
+    except UsernameTaken:
+        raise HTTPException(status_code=409, detail='User already exists')
+    return user
+
+
+@app.get('/user', response_model_exclude={'password'})
+async def get_user(auth: Annotated[HTTPBasicCredentials, Depends(security)]) -> User:
+    # the usernames are compared with secrets.compare_digest in the store, and the passwords with bcrypt
+    user = await verifier.verify(auth.username, auth.password)
 
-    if not (username_match and password_match):
-        raise HTTPException(status_code=401)
+    if user is None:
+        log.info('invalid credentials', username=auth.username)
+        raise HTTPException(status_code=401, headers={'WWW-Authenticate': 'Basic'})
 
     return user
@@ -0,0 +1,153 @@
+"""
+Verifying HTTP Basic credentials without running bcrypt on every request.
+
+With Basic auth, the client sends its username and password with every request, and checking a password is a bcrypt
+verify: tens to hundreds of milliseconds of CPU, on purpose. A client making requests in a loop pays that every time.
+
+BasicAuthVerifier remembers credentials it has verified, for a short while (X_BASIC_AUTH_CACHE_TTL, a minute by default):
+    - entries are keyed by an HMAC of the username and password, with a key that's random and private to this process.
+      the plaintext password is never stored, and the digest can't be brute forced without the key
+    - an entry also holds the password hash it was verified against. on a hit, the user is looked up again (cheap, no
+      bcrypt) and the hit only counts if the stored hash is still the same. so a changed password (or a deleted user)
+      takes effect right away, even if the change was made by another worker
+    - invalidate() moves to a new epoch, which is mixed into every key: everything cached before is unreachable at once.
+      for mass password changes, a leak, or anything else that the hash check doesn't catch. PUT /admin/passwords (see
+      password_admin_router) changes any number of passwords and then invalidates. it only invalidates this worker's
+      cache; on the other workers, the changed hashes miss on their own, the rest expire with their TTL
+    - cached() only looks at the cache. the apps call it before their login throttle, so a repeat request with
+      credentials that were already verified is neither hashed nor counted as a login attempt
+    - wrong passwords are never cached. they always pay for a bcrypt verify (and the logins are rate limited)
+    - the cache is bounded (LRU). see cache.py
+
+Config (environment variables):
+    X_BASIC_AUTH_CACHE_TTL      seconds a verified username/password stays cached. 0 turns the cache off
+    X_BASIC_AUTH_CACHE_SIZE     max cached credentials. defaults to 10000
+    X_ADMIN_KEY                 the X-Admin-Key that PUT /admin/passwords wants. not set: the route answers 404
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from typing import Annotated, Any, Callable
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from .cache import TTLCache
+from .hashing import PasswordHasher
+
+BASIC_AUTH_CACHE_TTL = float(os.environ.get('X_BASIC_AUTH_CACHE_TTL', 60))
+BASIC_AUTH_CACHE_SIZE = int(os.environ.get('X_BASIC_AUTH_CACHE_SIZE', 10_000))
+ADMIN_KEY = os.environ.get('X_ADMIN_KEY')
+
+
+class BasicAuthVerifier:
+
+    def __init__(
+            self,
+            hasher: PasswordHasher,
+            lookup: Callable[[str], Any],
+            rehash: Callable[[str, str], Any] | None = None,
+            ttl: float = BASIC_AUTH_CACHE_TTL,
+            maxsize: int = BASIC_AUTH_CACHE_SIZE
+    ):
+        """
+        :param hasher: verifies passwords against the stored hashes (off the event loop)
+        :param lookup: username -> the user (anything with a hashed .password), or None
+        :param rehash: called with (username, new_hash) when a password's hash was made with outdated settings
+        """
+        self.hasher = hasher
+        self.lookup = lookup
+        self.rehash = rehash
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._key = secrets.token_bytes(32)
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _digest(self, username: str, password: str) -> bytes:
+        # the lengths keep ('ab', 'c') and ('a', 'bc') apart
+        message = f'{self._epoch}:{len(username)}:{username}:{password}'.encode('utf8')
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def _hit(self, key: bytes, user: Any) -> bool:
+        verified_hash = self.cache.get(key)
+        return verified_hash is not None and secrets.compare_digest(verified_hash, user.password)
+
+    def cached(self, username: str, password: str) -> Any:
+        """
+        Returns the user if these credentials were verified recently (and the password hasn't changed since), else None.
+        Never hashes anything.
+        """
+        user = self.lookup(username)
+        if user is None or not password or not self._hit(self._digest(username, password), user):
+            return None
+        return user
+
+    async def verify(self, username: str, password: str) -> Any:
+        """
+        Returns the user if the password is right, or None (unknown user, or wrong password).
+        """
+        user = self.lookup(username)
+        if user is None or not password:
+            return None
+
+        key = self._digest(username, password)
+        if self._hit(key, user):
+            return user
+
+        verified, new_hash = await self.hasher.verify_and_update(password, user.password)
+        if not verified:
+            return None
+        if new_hash is not None and self.rehash is not None:
+            user = self.rehash(username, new_hash) or user
+        self.cache.set(key, user.password)
+        return user
+
+    def invalidate(self):
+        # clearing alone isn't enough: a verify that's waiting on bcrypt right now would cache its result right after.
+        # that result goes in under a key with the old epoch in it, which nobody looks up anymore
+        with self._lock:
+            self._epoch += 1
+            self.cache.clear()
+
+    async def change_passwords(self, passwords: dict[str, str], store: Callable[[str, str], Any]) -> list[str]:
+        """
+        A mass password change (say, after a leak). Hashes each new password, stores it with store(username, new_hash),
+        and then invalidates the cache. Returns the usernames that were changed. Unknown ones are skipped.
+        """
+        changed = []
+        for username, password in passwords.items():
+            if await run_in_threadpool(self.lookup, username) is None:
+                continue
+            await run_in_threadpool(store, username, await self.hasher.hash(password))
+            changed.append(username)
+        # the changed hashes would already miss in the cache, but after a mass change nothing cached before it should be
+        # trusted anymore
+        self.invalidate()
+        return changed
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), 'epoch': self._epoch}
+
+
+def admin_key_verifier(admin_key: Annotated[str | None, Header(alias='X-Admin-Key')] = None):
+    if ADMIN_KEY is None:
+        raise HTTPException(status_code=404, detail='Not Found')
+    if admin_key is None or not secrets.compare_digest(admin_key.encode('utf8'), ADMIN_KEY.encode('utf8')):
+        raise HTTPException(status_code=403, detail='Invalid admin key')
+
+
+def password_admin_router(verifier: BasicAuthVerifier, store: Callable[[str, str], Any]) -> APIRouter:
+    """
+    PUT /admin/passwords, with a {username: new password} body: changes the passwords and invalidates the verifier's
+    cache. Needs the X-Admin-Key header. see verifier.change_passwords
+    """
+    router = APIRouter(dependencies=[Depends(admin_key_verifier)])
+
+    @router.put('/admin/passwords')
+    async def change_passwords(passwords: dict[str, str]) -> dict[str, list[str]]:
+        return {'changed': await verifier.change_passwords(passwords, store)}
+
+    return router
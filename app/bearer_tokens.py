@@ -0,0 +1,187 @@
+"""
+The JWT side of the two advanced oauth apps, in one place.
+
+oauth_passlib_advanced.py and oauth_passlib_advanced_with_basic_auth.py only differ in how a login checks the password
+(a form, or HTTP Basic) and which table their journals live in. Everything after the password check is the same: the
+access tokens, the rotating refresh tokens (see refresh_tokens.py), and the routes that use them. Each app makes a
+BearerTokens for its journals, includes its router, and calls issue() once a login has checked out:
+    POST /refresh                   a new access token (and refresh token) for a refresh token. no bcrypt
+    GET  /journal                   the journal of the token's 'sub', with an ETag. see etags.py
+    POST /logout                    revokes the access token, and the refresh tokens it was handed out with
+    GET  /.well-known/jwks.json     the public keys the tokens are signed with. see keyring.py
+"""
+
+import secrets
+from datetime import datetime, timedelta
+from typing import Annotated, Any, Callable
+
+from fastapi import APIRouter, Depends, Form, HTTPException, Request, Response
+from fastapi.security import OAuth2PasswordBearer
+from jose import JWTError, ExpiredSignatureError
+from pydantic import BaseModel, Field
+
+from .etags import etag_matches, etag_headers, not_modified_response
+from .jwt_cache import DecodedTokenCache
+from .keyring import keyring
+from .refresh_tokens import RefreshTokens, RefreshRejected
+from .revocation import revocations
+
+API_KEY_TTL = 300
+
+
+def get_token_expiry(ttl: int = API_KEY_TTL) -> datetime:
+    # use utc time to get current universal time, and then set the expiry date of a token by adding the timedelta.
+    # in this case it is 300 seconds (5 minutes)
+    return datetime.utcnow() + timedelta(seconds=ttl)
+
+
+def decode_access_token(token: str) -> dict:
+    # decoding the token is fairly the same process as encoding it.
+    # the keyring picks the key (and the one algorithm it allows) by the token's 'kid' header, and passes the already
+    # parsed key to jwt.decode. see keyring.py
+    return keyring.decode(token)
+
+
+class AccessToken(BaseModel):
+    """
+    Helper class for generating access token.
+    'sub' and 'exp' are fields to be used in the JWT.
+        sub - refers to something like a username. The important thing to have in mind is that the sub key should have a
+            unique identifier across the entire application, and it should be a string.
+        exp - refers to the expiry time of the token
+        jti - a unique id for the token, so that it can be revoked (logged out) before it expires. see revocation.py
+        fam - the refresh token family the token was handed out with. revoking the family revokes this token too
+    """
+
+    sub: str
+    exp: datetime = Field(default_factory=get_token_expiry)
+    jti: str = Field(default_factory=lambda: secrets.token_urlsafe(16))
+    fam: str | None = None
+
+    def generate(self, refresh_token: str | None = None):
+        # jwt.encode with the payload dict, the keyring's active key and its algorithm. the key's id goes in the header
+        token = keyring.encode(self.model_dump(exclude_none=True))
+        response = {    # remember to use the keys exactly as defined by oauth standards
+            "access_token": token,
+            "token_type": "bearer",
+            "expires_in": API_KEY_TTL,
+        }
+        if refresh_token is not None:
+            response["refresh_token"] = refresh_token
+        return response
+
+
+class BearerTokens:
+
+    def __init__(self, journal_model: type, token_url: str, journal_etag: Callable[[int, str], str]):
+        """
+        :param journal_model: the app's Journal class (get and get_versioned are used)
+        :param token_url: the app's login route, for the OpenAPI docs
+        :param journal_etag: (version, username) -> the ETag of that journal
+        """
+        self.journal_model = journal_model
+        self.journal_etag = journal_etag
+        self.oauth2 = OAuth2PasswordBearer(tokenUrl=token_url)
+        # verified claims + resolved journals, keyed by token. entries expire together with their token
+        self.decoded_token_cache = DecodedTokenCache(maxsize=4096, ttl=API_KEY_TTL)
+        # long lived, single use tokens for getting new access tokens without the password (and without bcrypt).
+        # see refresh_tokens.py
+        self.refresh_tokens = RefreshTokens(keyring)
+        self.router = self._router()
+
+    def issue(self, username: str) -> dict:
+        # a login: a new access token, and a refresh token that starts a new family
+        refresh_token, family = self.refresh_tokens.issue(username)
+        return AccessToken(sub=username, fam=family).generate(refresh_token)
+
+    def _router(self) -> APIRouter:
+        # the routes are plain defs: the journal store and the revocation list are SQLite, so they run in the
+        # threadpool rather than on the event loop
+        router = APIRouter()
+        Journal = self.journal_model
+        oauth2 = self.oauth2
+        refresh_tokens = self.refresh_tokens
+
+        @router.post('/refresh')
+        def refresh_access_token(
+                refresh_token: Annotated[str, Form()],
+                grant_type: Annotated[str, Form()] = 'refresh_token'
+        ):
+            # the oauth refresh grant: form fields grant_type=refresh_token and refresh_token=<the refresh token>.
+            # no password, so no bcrypt. a signature check, and a lookup or two in the revocation list
+            if grant_type != 'refresh_token':
+                raise HTTPException(status_code=400, detail='Unsupported grant type')
+            try:
+                # the refresh token is used up here, and replaced with a new one. see refresh_tokens.py
+                claims, new_refresh_token = refresh_tokens.rotate(refresh_token)
+            except RefreshRejected as e:
+                raise HTTPException(status_code=401, detail=f'Invalid refresh token ({e.reason})', headers={'WWW-Authenticate': 'Bearer'})
+
+            if Journal.get(claims['sub']) is None:     # the journal was deleted since the login
+                refresh_tokens.revoke_family(claims['fam'])
+                raise HTTPException(status_code=401, detail='Invalid refresh token', headers={'WWW-Authenticate': 'Bearer'})
+            return AccessToken(sub=claims['sub'], fam=claims['fam']).generate(new_refresh_token)
+
+        @router.get('/journal', response_model=Journal, response_model_exclude={'password'})
+        def get_journal(request: Request, token: Annotated[str, Depends(oauth2)]) -> Any:
+            CredentialsError = HTTPException(status_code=401, detail='Invalid authorization', headers={'WWW-Authenticate': 'Bearer'})
+
+            try:
+                # the token is only decoded (and the journal only looked up) the first time we see it. after that, the
+                # claims and the journal come from the cache until the token expires. see jwt_cache.py
+                claims, journal = self.decoded_token_cache.resolve(token, decode_access_token, Journal.get)
+
+                if journal is None:     # no 'sub' claim, or no journal for it
+                    raise CredentialsError
+                if claims.get('typ') == RefreshTokens.TYPE:     # refresh tokens are only good for /refresh
+                    raise CredentialsError
+                # checked on every request, cached or not. with several workers, the list is shared. see serve.py
+                if 'jti' in claims and revocations.is_revoked(claims['jti']):
+                    raise CredentialsError
+                if 'fam' in claims and refresh_tokens.is_family_revoked(claims['fam']):
+                    raise CredentialsError
+
+                # the journal in the token cache can be a few minutes old. for the ETag, it's read again together with
+                # the version of its table (from the journals cache, after the usual version query - see storage.py).
+                # unchanged since the client's copy: 304. see etags.py
+                version, journal = Journal.get_versioned(journal.username)
+                if journal is None:
+                    raise CredentialsError
+                etag = self.journal_etag(version, journal.username)
+                if etag_matches(request, etag):
+                    return not_modified_response(etag, private=True)
+                return Response(
+                    journal.model_dump_json(exclude={'password'}),
+                    media_type='application/json',
+                    headers=etag_headers(etag, private=True)
+                )
+            except ExpiredSignatureError:
+                # error thrown when the JWT expires. in that case, the client will have to request a new token.
+                # you can return information in the http exception that will hint the client code that it will have to
+                # request a new token.
+                raise HTTPException(status_code=401, detail="Expired token")
+            except JWTError:
+                raise CredentialsError
+
+        @router.post('/logout', status_code=204)
+        def log_out(token: Annotated[str, Depends(oauth2)]):
+            # revokes the access token. it stays on the revocation list until it would have expired anyway.
+            # the refresh tokens it was handed out with are revoked as well, so the session can't be refreshed back to
+            # life
+            try:
+                claims = decode_access_token(token)
+            except JWTError:
+                raise HTTPException(status_code=401, detail='Invalid authorization', headers={'WWW-Authenticate': 'Bearer'})
+            if 'jti' in claims:
+                revocations.revoke(claims['jti'], claims['exp'])
+            if 'fam' in claims:
+                refresh_tokens.revoke_family(claims['fam'])
+            return Response(status_code=204)
+
+        @router.get('/.well-known/jwks.json')
+        def get_jwks():
+            # the public keys that tokens are signed with, so that other services can verify our tokens on their own.
+            # HMAC secrets are never listed
+            return keyring.jwks()
+
+        return router
@@ -0,0 +1,211 @@
+"""
+Response compression: gzip, brotli or zstd, whichever the client prefers (see encoding.py).
+
+CompressionMiddleware is a plain ASGI middleware, like MetricsMiddleware. It wraps `send`, and for each response:
+    - picks an encoding from the request's Accept-Encoding. no match: the response isn't touched at all
+    - leaves alone responses that shouldn't or can't be compressed: ones that already have a Content-Encoding (the
+      prerendered pages compress themselves, once, up front - see prerendered.py), types that are compressed already
+      (images, archives...) or aren't worth it, partial content (206), bodies smaller than X_COMPRESS_MIN_SIZE, and
+      files sent with the zero-copy extensions (see file_responses.py)
+    - a response sent in one piece is compressed in one go, and gets a new Content-Length. large bodies are compressed
+      in a worker thread (zlib, brotli and zstd all let go of the GIL while they work), so the event loop keeps going
+    - a streamed response (StreamingResponse, e.g. /team/recruits/stream) is compressed chunk by chunk as it's sent. each
+      chunk is flushed out of the compressor right away, so the client doesn't wait for the end of the stream
+    - adds Vary: Accept-Encoding, so that caches keep the variants apart
+
+The levels are the fast ones (gzip 6, brotli 4, zstd 3). Bodies we can afford to compress harder are the ones that don't
+change, and those are better compressed once up front (prerendered.py) than on every response.
+
+Config (environment variables):
+    X_COMPRESS_MIN_SIZE         bodies smaller than this (in bytes) are sent as is. defaults to 512
+    X_COMPRESS_THREAD_MIN_SIZE  bodies at least this large are compressed in a worker thread. defaults to 256 KiB
+    X_COMPRESS_ENCODINGS        the encodings to offer, comma separated. defaults to all the available ones
+
+Usage:
+    install_compression(app, 'main')
+"""
+
+import os
+
+import anyio
+from fastapi import FastAPI
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .encoding import AVAILABLE_ENCODINGS, StreamCompressor, negotiate
+from .metrics import registry
+
+COMPRESS_MIN_SIZE = int(os.environ.get('X_COMPRESS_MIN_SIZE', 512))
+COMPRESS_THREAD_MIN_SIZE = int(os.environ.get('X_COMPRESS_THREAD_MIN_SIZE', 256 * 1024))
+COMPRESS_ENCODINGS = tuple(
+    encoding for encoding in AVAILABLE_ENCODINGS
+    if encoding in os.environ.get('X_COMPRESS_ENCODINGS', ','.join(AVAILABLE_ENCODINGS)).split(',')
+)
+
+# content types worth compressing. everything else (images, video, archives, fonts...) is usually compressed already
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/x-ndjson', 'application/javascript', 'application/xml',
+    'application/xhtml+xml', 'image/svg+xml',
+)
+COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+
+
+def new_counts() -> dict[str, int]:
+    return {'compressed': 0, 'streamed': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+def is_compressible(content_type: str | None) -> bool:
+    if not content_type:
+        return False
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type.startswith(COMPRESSIBLE_TYPES) or media_type.endswith(COMPRESSIBLE_SUFFIXES)
+
+
+class CompressionMiddleware:
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            min_size: int = COMPRESS_MIN_SIZE,
+            thread_min_size: int = COMPRESS_THREAD_MIN_SIZE,
+            encodings: tuple[str, ...] = COMPRESS_ENCODINGS,
+            counts: dict[str, int] | None = None
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.thread_min_size = thread_min_size
+        self.encodings = encodings
+        self.counts = counts if counts is not None else new_counts()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['method'] == 'HEAD':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding'), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressedResponder(self, encoding, send)(self.app, scope, receive)
+
+
+class CompressedResponder:
+    # one per response. holds back the response start until the first body chunk shows whether to compress
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start: Message | None = None
+        self.compressor: StreamCompressor | None = None
+        self.passthrough = False
+
+    async def __call__(self, app: ASGIApp, scope: Scope, receive: Receive):
+        await app(scope, receive, self.send_wrapper)
+
+    def _should_compress(self, headers: Headers, status: int) -> bool:
+        if status < 200 or status in (204, 206, 304):
+            return False
+        if 'content-encoding' in headers or 'content-range' in headers:
+            return False
+        if 'no-transform' in headers.get('cache-control', ''):
+            return False
+        return is_compressible(headers.get('content-type'))
+
+    async def send_wrapper(self, message: Message):
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        if message['type'] == 'http.response.start':
+            headers = Headers(raw=message.get('headers', []))
+            if not self._should_compress(headers, message['status']):
+                self.passthrough = True
+                self.middleware.counts['skipped'] += 1
+                await self.send(message)
+                return
+            self.start = message    # sent along with the first chunk
+            return
+
+        if message['type'] != 'http.response.body':
+            # zero-copy file sends (http.response.zerocopysend, pathsend). the server writes the file itself, so there's
+            # no body for us to compress
+            if self.start is not None and self.compressor is None:
+                await self.send(self.start)
+                self.middleware.counts['skipped'] += 1
+                self.passthrough = True
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        counts = self.middleware.counts
+
+        if self.compressor is None:
+            start = self.start
+            headers = MutableHeaders(raw=list(start.get('headers', [])))
+
+            if not more_body:
+                # the whole body in one message
+                if len(body) < self.middleware.min_size:
+                    self.passthrough = True
+                    counts['skipped'] += 1
+                    headers.add_vary_header('Accept-Encoding')
+                    start['headers'] = headers.raw
+                    await self.send(start)
+                    await self.send(message)
+                    return
+                compressed = await self._compress_all(body)
+                counts['compressed'] += 1
+                counts['bytes_in'] += len(body)
+                counts['bytes_out'] += len(compressed)
+                self._set_headers(headers)
+                headers['content-length'] = str(len(compressed))
+                start['headers'] = headers.raw
+                await self.send(start)
+                await self.send({'type': 'http.response.body', 'body': compressed})
+                return
+
+            # a streamed body. we can't know its compressed length up front, so it goes out without a Content-Length
+            self.compressor = StreamCompressor(self.encoding)
+            counts['streamed'] += 1
+            self._set_headers(headers)
+            del headers['content-length']
+            start['headers'] = headers.raw
+            await self.send(start)
+
+        chunk = self.compressor.compress(body)
+        chunk += self.compressor.flush() if more_body else self.compressor.finish()
+        counts['bytes_in'] += len(body)
+        counts['bytes_out'] += len(chunk)
+        if chunk or not more_body:
+            await self.send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+
+    def _set_headers(self, headers: MutableHeaders):
+        headers['content-encoding'] = self.encoding
+        headers.add_vary_header('Accept-Encoding')
+        etag = headers.get('etag')
+        if etag is not None and not etag.startswith('W/'):
+            # the compressed body isn't byte for byte the same as the one the strong ETag was made for
+            headers['etag'] = f'W/{etag}'
+
+    async def _compress_all(self, body: bytes) -> bytes:
+        compressor = StreamCompressor(self.encoding)
+
+        def compress() -> bytes:
+            return compressor.compress(body) + compressor.finish()
+
+        if len(body) >= self.middleware.thread_min_size:
+            return await anyio.to_thread.run_sync(compress)
+        return compress()
+
+
+def install_compression(app: FastAPI, app_name: str):
+    """
+    Compresses the app's responses with gzip, brotli or zstd, whichever the client accepts, and counts what was
+    compressed (under 'compression' at /metrics).
+    Call it before install_metrics, so that the metrics middleware (which then ends up outside of this one) times the
+    compression too.
+    """
+    counts = new_counts()
+    app.add_middleware(CompressionMiddleware, counts=counts)
+    registry.register_stats('compression', lambda: dict(counts), {'app': app_name})
@@ -1,12 +1,21 @@
 from fastapi import FastAPI, Depends, Request, Response, HTTPException
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from typing import Annotated
-from main import SecureRecruit
+from .models import SecureRecruit
+from .metrics import install_metrics
+from .compression import install_compression
+from .rate_limit import login_throttle, RateLimited, rate_limited_handler
+from .log import get_logger
+
+log = get_logger(__name__)
 
 
 oauth2 = OAuth2PasswordBearer(tokenUrl='gen-token')
 
 app = FastAPI()
+install_compression(app, 'dough')
+install_metrics(app, 'dough')
+app.add_exception_handler(RateLimited, rate_limited_handler)
 
 
 async def get_user_from_token(token: Annotated[str, Depends(oauth2)]) -> SecureRecruit:
@@ -16,13 +25,17 @@ async def get_user_from_token(token: Annotated[str, Depends(oauth2)]) -> SecureR
 
 
 @app.post('/gen-token')
-def get_access_token(credentials: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def get_access_token(request: Request, credentials: Annotated[OAuth2PasswordRequestForm, Depends()]):
     username = credentials.username
     pwd = credentials.password
 
+    await login_throttle.check(request, username, scope='dough')
+
     if username != 'admin':
+        log.info('invalid username', username=username)
         raise HTTPException(status_code=401, detail="invalid username: you can't hang here")
     if pwd != 'strong123':
+        log.info('invalid password', username=username)
         raise HTTPException(status_code=401, detail="please check your password and try again :/")
 
     return {
@@ -0,0 +1,126 @@
+"""
+Content-Encoding helpers: which compressions we can do, and which one a client wants.
+
+gzip is always available (zlib is in the standard library). brotli and zstd are optional - install the `brotli` and
+`zstandard` packages to enable them. Without them, those encodings are simply never negotiated.
+
+compress() is for bodies we have in full and compress once (see prerendered.py). StreamCompressor is for bodies that
+are compressed while they're sent (see compression.py).
+"""
+
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:     # optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:     # optional dependency
+    zstandard = None
+
+
+# in order of preference, when the client likes several equally
+AVAILABLE_ENCODINGS = tuple(
+    encoding for encoding, available in (('br', brotli), ('zstd', zstandard), ('gzip', True)) if available
+)
+
+
+def parse_accept_encoding(header: str | None) -> dict[str, float]:
+    # "gzip, br;q=0.9, *;q=0" -> {'gzip': 1.0, 'br': 0.9, '*': 0.0}
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def negotiate(header: str | None, available: tuple[str, ...] = AVAILABLE_ENCODINGS) -> str | None:
+    """
+    Picks the encoding to use for a response, out of `available`, based on the Accept-Encoding request header.
+    Returns None if the body should be sent as is.
+    """
+    accepted = parse_accept_encoding(header)
+    if not accepted:
+        return None
+
+    wildcard = accepted.get('*', 0.0)
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str, level: int | None = None) -> bytes:
+    # one-shot compression. for precomputing variants, so the default levels favour size over speed
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9 if level is None else level, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(body, quality=11 if level is None else level)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=19 if level is None else level).compress(body)
+    raise ValueError(f"unsupported encoding: {encoding}")
+
+
+def gzip_compressobj(level: int = 6):
+    # a streaming gzip compressor (wbits=31 means: zlib deflate, wrapped in a gzip header/trailer)
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+# for compressing responses as they're sent, where speed matters more than the last few percent of size
+FAST_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+
+
+class StreamCompressor:
+    """
+    Compresses a body that comes in chunks, with the same three calls whatever the encoding:
+        compress(chunk)     compresses a chunk. may return b'' if the compressor is still buffering
+        flush()             returns everything compressed so far, so that it can be sent now (a streamed response
+                            shouldn't sit in the compressor's buffer until the end)
+        finish()            returns the rest, and ends the stream
+    """
+
+    def __init__(self, encoding: str, level: int | None = None):
+        level = FAST_LEVELS[encoding] if level is None else level
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._compressor = gzip_compressobj(level)
+        elif encoding == 'br' and brotli is not None:
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == 'zstd' and zstandard is not None:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"unsupported encoding: {encoding}")
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(chunk)
+        return self._compressor.compress(chunk)
+
+    def flush(self) -> bytes:
+        if self.encoding == 'gzip':
+            return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'zstd':
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
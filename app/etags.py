@@ -0,0 +1,50 @@
+"""
+ETags made from the stores' version numbers, for the read endpoints that clients poll.
+
+Every write to a table bumps its version number (see storage.py), so "version 42 of the recruits table" says all there
+is to say about the roster: no need to serialize the response and hash the body to find out whether it changed. The
+ETag is just that, plus:
+    - the database's instance id. versions start over in a new database file, and old ETags must not match new data
+    - a keyed digest of whatever picks the record out, for endpoints where that isn't in the URL (the bearer token picks
+      the journal on GET /journal). the key is the instance id, so the digest is the same on every worker, and the
+      ETag doesn't give away the username
+
+If the client's If-None-Match matches, the endpoint answers 304 Not Modified right away: no validation, no serialization,
+no body. The version has to be read *before* the data it's for - then the data can only be newer than its ETag says,
+never older, and a client can't end up holding stale data under a current ETag.
+
+Cache-Control: no-cache goes along with the ETag, so that clients (and caches) revalidate every time instead of
+guessing how long the data stays fresh.
+"""
+
+import hashlib
+
+from fastapi import Request, Response
+
+from .storage import Database
+
+
+def version_etag(db: Database, kind: str, version: int, key: str | None = None) -> str:
+    parts = [db.instance_id(), f'{kind}{version}']
+    if key is not None:
+        parts.append(hashlib.blake2b(key.encode('utf8'), key=db.instance_id().encode(), digest_size=8).hexdigest())
+    return '"' + '-'.join(parts) + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # the one If-None-Match check, for every ETag we hand out (static_cache.py and prerendered.py use it too).
+    # weak comparison: W/"x" matches "x". compression.py turns our strong ETags into weak ones
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def etag_headers(etag: str, private: bool = False) -> dict[str, str]:
+    # private: the response is for one user only (it needed a token), so shared caches mustn't keep it
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache' if private else 'no-cache'}
+
+
+def not_modified_response(etag: str, private: bool = False) -> Response:
+    return Response(status_code=304, headers=etag_headers(etag, private))
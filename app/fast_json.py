@@ -0,0 +1,40 @@
+"""
+JSON responses without the jsonable_encoder detour.
+
+FastAPI's default path for a returned value is: validate it against the response model, turn it into a tree of plain
+dicts/lists (jsonable_encoder or the model's serializer in python mode), and then json.dumps that tree. For a list of a
+few thousand recruits, building and then walking that intermediate tree is most of the work.
+
+Pydantic v2 can write JSON bytes directly (model_dump_json / TypeAdapter.dump_json, implemented in Rust), and
+pydantic_core.to_json can do the same for arbitrary values: dicts, lists, models, dataclasses, dates, enums (also as
+dict keys, e.g. Title), HttpUrl, ...
+
+    FastJSONResponse    a JSONResponse that renders with pydantic_core.to_json. use it as an app's
+                        default_response_class, or return it from an endpoint to skip jsonable_encoder altogether
+    json_response       serializes a value with a TypeAdapter straight into a response. the adapter's type decides the
+                        shape, like a response_model would (a Recruit dumped as a BaseRecruit only has BaseRecruit's
+                        fields). keep response_model on the decorator, so the OpenAPI schema stays the same
+"""
+
+from typing import Any
+
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+from starlette.responses import JSONResponse, Response
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):    # already serialized
+            return content
+        return to_json(content)
+
+
+def json_response(
+        value: Any,
+        adapter: TypeAdapter,
+        status_code: int = 200,
+        headers: dict[str, str] | None = None
+) -> Response:
+    return Response(adapter.dump_json(value), status_code=status_code, headers=headers, media_type='application/json')
@@ -0,0 +1,144 @@
+"""
+Sending files (or parts of files) without reading them into memory.
+
+FileStreamResponse picks the cheapest way to get the bytes out that the server supports:
+    - the ASGI zero-copy send extension (http.response.zerocopysend): we hand the server a file descriptor, offset and
+      count, and it can use sendfile(2) - the kernel copies straight from the page cache to the socket
+    - the ASGI path send extension (http.response.pathsend), for whole files: we hand the server the path
+    - otherwise, a plain chunked read with a bounded buffer: one chunk (64 KiB) is read in a worker thread, sent, and
+      only then is the next one read. send() waits for the client to keep up, so a slow client can't make us buffer
+      the file in memory
+
+parse_range handles the Range request header, for resumable downloads (206 Partial Content).
+"""
+
+import os
+from email.utils import formatdate
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+def safe_join(root: str, path: str) -> str | None:
+    """
+    Joins a client-supplied path onto root, or returns None if the result would end up outside of root, e.g.
+    '../../etc/passwd', an absolute path, or a symlink that points out of root.
+    """
+    if '\0' in path:
+        return None
+    root = os.path.realpath(root)
+    target = os.path.realpath(os.path.join(root, path.lstrip('/')))
+    if os.path.commonpath([root, target]) != root:
+        return None
+    return target
+
+
+class RangeNotSatisfiable(Exception):
+
+    def __init__(self, size: int):
+        self.size = size
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parses a Range header into the (offset, length) to send. Returns None if the whole file should be sent: no Range
+    header, a unit other than bytes, or several ranges (which we're allowed to ignore, and serve the whole file instead).
+    Raises RangeNotSatisfiable if the range lies outside the file.
+        bytes=0-499   the first 500 bytes
+        bytes=500-    everything from byte 500 on
+        bytes=-500    the last 500 bytes
+    """
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if first == '':     # suffix range
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(size)
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None     # malformed ranges are ignored, not rejected
+
+    if start >= size:
+        raise RangeNotSatisfiable(size)
+    if start < 0 or start > end:
+        return None
+    end = min(end, size - 1)
+    return start, end - start + 1
+
+
+class FileStreamResponse(Response):
+    chunk_size = 64 * 1024
+
+    def __init__(
+            self,
+            path: str,
+            stat_result: os.stat_result,
+            status_code: int = 200,
+            headers: dict[str, str] | None = None,
+            media_type: str | None = None,
+            offset: int = 0,
+            length: int | None = None
+    ):
+        self.path = path
+        self.stat_result = stat_result
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.offset = offset
+        self.length = stat_result.st_size - offset if length is None else length
+
+        self.init_headers(headers)
+        self.headers['content-length'] = str(self.length)
+        self.headers.setdefault('last-modified', formatdate(stat_result.st_mtime, usegmt=True))
+        self.headers.setdefault('accept-ranges', 'bytes')
+        if status_code == 206:
+            last = self.offset + self.length - 1
+            self.headers['content-range'] = f'bytes {self.offset}-{last}/{stat_result.st_size}'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        if scope.get('method') == 'HEAD' or self.length == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        extensions = scope.get('extensions') or {}
+        if 'http.response.zerocopysend' in extensions:
+            with open(self.path, 'rb') as file:
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': file.fileno(),
+                    'offset': self.offset,
+                    'count': self.length,
+                    'more_body': False
+                })
+        elif 'http.response.pathsend' in extensions and self.offset == 0 and self.length == self.stat_result.st_size:
+            await send({'type': 'http.response.pathsend', 'path': os.path.abspath(self.path)})
+        else:
+            await self._send_chunks(send)
+
+    async def _send_chunks(self, send: Send):
+        remaining = self.length
+        async with await anyio.open_file(self.path, 'rb') as file:
+            if self.offset:
+                await file.seek(self.offset)
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:   # the file got shorter under us. end the body rather than hang
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
@@ -0,0 +1,112 @@
+"""
+One ASGI app that serves all the others, each under its own prefix:
+
+    /main           main.py
+    /oauth          oauth_passlib_advanced.py
+    /basic-oauth    oauth_passlib_advanced_with_basic_auth.py
+    /simple-oauth   simple_oauth_passlib.py
+    /basic          basic_auth.py
+    /dough          dough.py
+    /more           more.py
+
+    python -m app.serve app.gateway:app --port 8000     (or: uvicorn app.gateway:app)
+
+One process (or one set of workers) and one port, instead of one per app.
+
+The sub-apps are mounted lazily. Starting the gateway imports none of them: a sub-app's module is imported (which is
+when its routes get built) and its lifespan is started (journal/recruit preloads, bcrypt calibration, email workers...)
+when the first request for its prefix comes in. Requests for other prefixes aren't held up meanwhile: the import runs
+in a worker thread. So the gateway starts in well under a second, and apps nobody calls cost nothing. The OpenAPI
+schema of each sub-app (at /<prefix>/docs) was already only built on first use.
+
+Starlette doesn't run the lifespan of mounted apps, so LazyApp runs it itself, and the gateway's lifespan shuts down
+every sub-app that was started.
+
+Config (environment variables):
+    X_GATEWAY_PRELOAD   comma separated prefixes to start at startup instead of on first request, e.g. 'main,oauth'.
+                        '*' starts them all
+"""
+
+import os
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import anyio
+from fastapi import FastAPI
+from starlette.types import ASGIApp, Receive, Scope, Send
+from uvicorn.importer import import_from_string
+
+from .metrics import metrics_endpoint
+
+MOUNTS = {
+    'main': 'app.main:app',
+    'oauth': 'app.oauth_passlib_advanced:app',
+    'basic-oauth': 'app.oauth_passlib_advanced_with_basic_auth:app',
+    'simple-oauth': 'app.simple_oauth_passlib:app',
+    'basic': 'app.basic_auth:app',
+    'dough': 'app.dough:app',
+    'more': 'app.more:app',
+}
+
+GATEWAY_PRELOAD = os.environ.get('X_GATEWAY_PRELOAD', '')
+
+
+class LazyApp:
+    """
+    An ASGI app that imports and starts the real app on the first request, and then hands every request to it.
+    """
+
+    def __init__(self, import_path: str, exit_stack: AsyncExitStack):
+        self.import_path = import_path
+        self.exit_stack = exit_stack
+        self.app: ASGIApp | None = None
+        self._lock = anyio.Lock()
+
+    async def start(self) -> ASGIApp:
+        async with self._lock:
+            if self.app is None:
+                # importing builds the app and all its routes. in a thread, so other mounts keep serving meanwhile
+                app = await anyio.to_thread.run_sync(import_from_string, self.import_path)
+                router = getattr(app, 'router', None)
+                if router is not None:
+                    # if the lifespan fails, the exception goes to this request, and the next one tries again
+                    await self.exit_stack.enter_async_context(router.lifespan_context(app))
+                self.app = app
+        return self.app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        app = self.app or await self.start()
+        await app(scope, receive, send)
+
+
+exit_stack = AsyncExitStack()
+lazy_apps = {prefix: LazyApp(path, exit_stack) for prefix, path in MOUNTS.items()}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preload = lazy_apps if GATEWAY_PRELOAD.strip() == '*' else [
+        prefix.strip() for prefix in GATEWAY_PRELOAD.split(',') if prefix.strip()
+    ]
+    for prefix in preload:
+        await lazy_apps[prefix].start()
+    try:
+        async with exit_stack:  # shuts down the sub-apps that were started, in reverse order
+            yield
+    finally:
+        for lazy_app in lazy_apps.values():
+            lazy_app.app = None     # started again on the next request, if the gateway is started again
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+for prefix, lazy_app in lazy_apps.items():
+    app.mount(f'/{prefix}', lazy_app)
+# the registry is shared by every app in the process, and series are labelled per app. this exposes all of them
+app.add_route('/metrics', metrics_endpoint, include_in_schema=False)
+
+
+@app.get('/')
+def list_apps():
+    return {
+        prefix: {"docs": f'/{prefix}/docs', "started": lazy_app.app is not None}
+        for prefix, lazy_app in lazy_apps.items()
+    }
@@ -0,0 +1,268 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is slow on purpose (~200ms per hash/verify). When CryptContext.hash or CryptContext.verify is called straight
+from an `async def` path operation, it runs on the event loop, and every other request on that worker waits for it.
+
+PasswordHasher wraps a CryptContext and exposes awaitable hash/verify methods that run the actual bcrypt work in a
+worker pool (threads by default - bcrypt releases the GIL - or processes). The pool is bounded: once
+X_HASH_WORKERS + X_HASH_QUEUE_SIZE jobs are waiting or running, new jobs are rejected with HasherBusy instead of
+piling up. HasherBusy is turned into a 503 by hasher_busy_handler.
+
+bcrypt's cost (rounds) decides how slow it is: every extra round doubles the work. passlib's default (12) might be
+~250ms on one machine and ~60ms on another. If X_BCRYPT_BUDGET_MS is set, PasswordHasher.calibrate (called from the
+app's lifespan) times bcrypt on this host, and picks the highest cost whose verify fits in the budget. Hashes made
+with any other cost are then flagged by the CryptContext as needing an update, and verify_and_update rehashes them the
+next time the user logs in successfully - the only time we have their password. No migration needed, in either
+direction.
+
+Config (environment variables):
+    X_HASH_POOL             'thread' (default) or 'process'
+    X_HASH_WORKERS          number of workers. defaults to the number of CPUs
+    X_HASH_QUEUE_SIZE       how many jobs can wait for a free worker before we start rejecting. defaults to 64
+    X_BCRYPT_BUDGET_MS      target time for one bcrypt verify, in milliseconds. not set: no calibration, and passlib's
+                            default cost is used
+    X_BCRYPT_MIN_ROUNDS     calibration never goes below this cost, however slow the host. defaults to 10
+    X_BCRYPT_MAX_ROUNDS     ...nor above this one. defaults to 16
+"""
+
+import asyncio
+import atexit
+import os
+import statistics
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from passlib.context import CryptContext
+from passlib.hash import bcrypt
+
+from .metrics import registry
+
+HASH_POOL = os.environ.get('X_HASH_POOL', 'thread')
+HASH_WORKERS = int(os.environ.get('X_HASH_WORKERS', os.cpu_count() or 1))
+HASH_QUEUE_SIZE = int(os.environ.get('X_HASH_QUEUE_SIZE', 64))
+BCRYPT_BUDGET_MS = float(os.environ['X_BCRYPT_BUDGET_MS']) if os.environ.get('X_BCRYPT_BUDGET_MS') else None
+BCRYPT_MIN_ROUNDS = int(os.environ.get('X_BCRYPT_MIN_ROUNDS', 10))
+BCRYPT_MAX_ROUNDS = int(os.environ.get('X_BCRYPT_MAX_ROUNDS', 16))
+
+
+class HasherBusy(Exception):
+
+    def __init__(self, pending: int):
+        self.pending = pending
+
+
+# worker functions. these live at module level so that they can be pickled and sent to a process pool.
+
+@lru_cache(maxsize=8)
+def _context_from_config(config: str) -> CryptContext:
+    return CryptContext.from_string(config)
+
+
+def _hash(config: str, secret: str) -> str:
+    return _context_from_config(config).hash(secret)
+
+
+def _verify(config: str, secret: str, hashed: str) -> bool:
+    return _context_from_config(config).verify(secret, hashed)
+
+
+def _verify_and_update(config: str, secret: str, hashed: str) -> tuple[bool, str | None]:
+    return _context_from_config(config).verify_and_update(secret, hashed)
+
+
+def _timed(fn, *args):
+    # runs fn in the worker and returns how long it actually took, so that we can tell time spent waiting in the
+    # queue apart from time spent hashing
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class HashingPool:
+
+    def __init__(self, kind: str = HASH_POOL, workers: int = HASH_WORKERS, queue_size: int = HASH_QUEUE_SIZE):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"unknown hashing pool kind: {kind}")
+
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor: Executor | None = None
+
+        # metrics. only ever touched from the event loop, so no locking needed
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.service_seconds_total = 0.0
+
+    def _get_executor(self) -> Executor:
+        # created lazily, so that merely importing an app doesn't spawn threads/processes (which matters when forking)
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hasher')
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        # jobs waiting for a free worker
+        return max(0, self.pending - self.workers)
+
+    async def run(self, fn, *args):
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HasherBusy(self.pending)
+
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, service_time = await loop.run_in_executor(self._get_executor(), _timed, fn, *args)
+        finally:
+            self.pending -= 1
+
+        wait_time = max(0.0, time.perf_counter() - submitted - service_time)
+        self.completed += 1
+        self.service_seconds_total += service_time
+        self.wait_seconds_total += wait_time
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_time)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "pool": self.kind,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "service_seconds_total": self.service_seconds_total,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# one pool shared by every hasher in the process, so that the bound applies to all the apps together. it outlives any
+# one app's lifespan (the gateway runs several apps on it), so it's only shut down when the process exits
+default_pool = HashingPool()
+atexit.register(default_pool.shutdown)
+registry.register_stats('password_hashing', default_pool.stats)
+
+
+def _bcrypt_seconds(rounds: int, samples: int = 3) -> float:
+    # median time of a bcrypt hash at the given cost. a verify does the same work as a hash
+    handler = bcrypt.using(rounds=rounds)
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash('calibration')
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def calibrate_bcrypt_rounds(budget_ms: float, min_rounds: int, max_rounds: int) -> tuple[int, float]:
+    """
+    Returns the highest bcrypt cost (within min/max) whose hash takes at most budget_ms on this host, and how long a
+    hash at that cost took, in milliseconds.
+    """
+    # time the cheapest cost, then extrapolate: each round doubles the work. and then check the guess, since the
+    # doubling isn't exact (and the host might be busy)
+    rounds = min_rounds
+    took = _bcrypt_seconds(rounds) * 1000
+    while rounds < max_rounds and took * 2 <= budget_ms:
+        rounds += 1
+        took *= 2
+
+    took = _bcrypt_seconds(rounds) * 1000
+    while took > budget_ms and rounds > min_rounds:
+        rounds -= 1
+        took = _bcrypt_seconds(rounds) * 1000
+    return rounds, took
+
+
+# the calibration is the same for every hasher in the process, so it's only measured once
+_calibrations: dict[tuple[float, int, int], tuple[int, float]] = {}
+
+
+class PasswordHasher:
+
+    def __init__(self, context: CryptContext, pool: HashingPool = default_pool):
+        self.context = context
+        self.pool = pool
+        self.rounds = context.handler('bcrypt').default_rounds if 'bcrypt' in context.schemes() else None
+        self.calibrated_ms = None
+        self.rehashed = 0
+
+    async def hash(self, secret: str) -> str:
+        if self.pool.kind == 'process':
+            # CryptContext can't be pickled, so process workers rebuild it from its config string
+            return await self.pool.run(_hash, self.context.to_string(), secret)
+        return await self.pool.run(self.context.hash, secret)
+
+    async def verify(self, secret: str, hashed: str) -> bool:
+        if self.pool.kind == 'process':
+            return await self.pool.run(_verify, self.context.to_string(), secret, hashed)
+        return await self.pool.run(self.context.verify, secret, hashed)
+
+    async def verify_and_update(self, secret: str, hashed: str) -> tuple[bool, str | None]:
+        """
+        Like verify, but if the password is right and the hash was made with outdated settings (e.g. another bcrypt cost
+        than the calibrated one), also returns a fresh hash of it, which the caller should store instead.
+        A successful login is the only time we have the plaintext password, so it's the only chance to redo the hash.
+        """
+        if self.pool.kind == 'process':
+            verified, new_hash = await self.pool.run(_verify_and_update, self.context.to_string(), secret, hashed)
+        else:
+            verified, new_hash = await self.pool.run(self.context.verify_and_update, secret, hashed)
+        if new_hash is not None:
+            self.rehashed += 1
+        return verified, new_hash
+
+    async def calibrate(
+            self,
+            budget_ms: float | None = BCRYPT_BUDGET_MS,
+            min_rounds: int = BCRYPT_MIN_ROUNDS,
+            max_rounds: int = BCRYPT_MAX_ROUNDS
+    ):
+        # sets the context's bcrypt cost to the calibrated one. hashes with any other cost will need an update
+        if budget_ms is None:
+            return
+
+        key = (budget_ms, min_rounds, max_rounds)
+        if key not in _calibrations:
+            # runs in a thread. it's a few seconds of hashing, which we don't want on the event loop
+            _calibrations[key] = await asyncio.to_thread(calibrate_bcrypt_rounds, *key)
+        rounds, took = _calibrations[key]
+
+        self.context.update(bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+        self.rounds = rounds
+        self.calibrated_ms = took
+
+    def stats(self) -> dict:
+        return {
+            "bcrypt_rounds": self.rounds,
+            "bcrypt_budget_ms": BCRYPT_BUDGET_MS,
+            "bcrypt_calibrated_ms": self.calibrated_ms,
+            "rehashed": self.rehashed,
+        }
+
+
+async def hasher_busy_handler(request: Request, e: HasherBusy):
+    return JSONResponse(
+        {"detail": "Server busy, try again shortly"},
+        status_code=503,
+        headers={'Retry-After': '1'}
+    )
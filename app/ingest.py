@@ -0,0 +1,209 @@
+"""
+Reading a stream of JSON records out of a request body, without buffering the whole body.
+
+Two formats are supported:
+    - NDJSON (Content-Type: application/x-ndjson): one JSON document per line
+    - a JSON array (Content-Type: application/json): [{...}, {...}, ...]
+Records are yielded as soon as they're complete, in order. A record that isn't valid JSON, or is larger than
+max_record_size, is yielded as a MalformedRecord in its place, and reading carries on with the next one. So every record
+gets a result, and a bad one never takes the ones after it down with it.
+"""
+
+import json
+from typing import Any, AsyncIterator
+
+MAX_RECORD_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+# what's skipped before the array starts, and between its elements
+_SEPARATORS = {False: ' \t\r\n', True: ', \t\r\n'}
+
+
+class MalformedRecord:
+
+    def __init__(self, detail: str):
+        self.detail = detail
+
+
+def _too_large(max_record_size: int) -> MalformedRecord:
+    return MalformedRecord(f"record is larger than {max_record_size} bytes")
+
+
+async def _ndjson_records(chunks: AsyncIterator[bytes], max_record_size: int) -> AsyncIterator[Any]:
+    buffer = b''
+    skipping = False    # in the middle of a line that's too large. it's dropped up to the next newline
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if skipping:
+                skipping = False    # that was the end of the oversized line, which has been reported already
+            elif len(line) > max_record_size:
+                yield _too_large(max_record_size)
+            elif line.strip():
+                yield _parse(line)
+        if len(buffer) > max_record_size:
+            # don't hold on to it. it's reported now, and the rest of it is skipped as it comes in
+            if not skipping:
+                yield _too_large(max_record_size)
+                skipping = True
+            buffer = b''
+    if buffer.strip() and not skipping:
+        yield _parse(buffer)
+
+
+def _parse(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return MalformedRecord(str(e))
+
+
+class _ElementScanner:
+    """
+    Finds where an array element ends - the ',' or ']' after it - without parsing it: it only keeps track of nesting
+    and of whether it's inside a string. Used for elements that don't decode, to tell a malformed element (its end is
+    there, so it's not just incomplete) from one that's still coming in, and to skip elements that are too large.
+    Scanning picks up where it left off, so every character is only looked at once.
+    """
+
+    def __init__(self):
+        self.position = 0   # relative to the start of the element
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def find_end(self, buffer: str, start: int) -> int:
+        # returns the index of the ',' or ']' that ends the element starting at buffer[start], or -1 if it's not there yet
+        index = start + self.position
+        while index < len(buffer):
+            char = buffer[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '[{':
+                self.depth += 1
+            elif char in ']}':
+                if self.depth == 0:
+                    return index    # the end of the array
+                self.depth -= 1
+            elif char == ',' and self.depth == 0:
+                return index
+            index += 1
+        self.position = index - start
+        return -1
+
+
+def _decode_at(buffer: str, position: int) -> tuple[Any, int]:
+    # the fast path: decode the element at `position` in place. it only counts if the ',' or ']' after it is there too -
+    # otherwise it may be cut short (a number split across chunks) or be followed by junk. returns (value, end), or
+    # (None, -1) if that didn't work out
+    try:
+        value, end = _decoder.raw_decode(buffer, position)
+    except ValueError:
+        return None, -1
+    while end < len(buffer) and buffer[end] in ' \t\r\n':
+        end += 1
+    if end == len(buffer) or buffer[end] not in ',]':
+        return None, -1
+    return value, end
+
+
+def _decode_element(element: str) -> Any:
+    element = element.strip()
+    try:
+        value, end = _decoder.raw_decode(element)
+    except ValueError as e:
+        return MalformedRecord(str(e))
+    if end != len(element):
+        return MalformedRecord("unexpected data after the value")
+    return value
+
+
+async def _json_array_records(chunks: AsyncIterator[bytes], max_record_size: int) -> AsyncIterator[Any]:
+    # a tiny incremental parser: find the opening '[', then repeatedly decode one value at `position`, skipping the
+    # commas in between, until the closing ']'. a value that fails to decode is scanned for its end as more data
+    # arrives: once that's there, it's decoded again (it was just incomplete) or reported as malformed, and reading
+    # carries on after it. one that grows past max_record_size is reported and skipped. the buffer is only cut down
+    # once per chunk, not once per record
+    buffer = ''
+    position = 0
+    started = finished = False
+    scanner: _ElementScanner | None = None      # set while we're looking for the end of an element
+    skipping = False    # the element being scanned is too large, and has been reported already
+    pending = b''   # a multi-byte utf8 character can be split across chunks
+
+    async for chunk in chunks:
+        pending += chunk
+        try:
+            buffer += pending.decode('utf8')
+            pending = b''
+        except UnicodeDecodeError as e:
+            buffer += pending[:e.start].decode('utf8')
+            pending = pending[e.start:]
+
+        while not finished:
+            if scanner is None:
+                while position < len(buffer) and buffer[position] in _SEPARATORS[started]:
+                    position += 1
+                if position == len(buffer):
+                    break
+                if not started:
+                    if buffer[position] != '[':
+                        yield MalformedRecord("expected a JSON array")
+                        return
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    finished = True
+                    break
+
+                value, end = _decode_at(buffer, position)
+                if end != -1 and end - position <= max_record_size:
+                    yield value
+                    position = end
+                    continue
+                scanner = _ElementScanner()
+
+            end = scanner.find_end(buffer, position)
+            if end == -1:
+                if not skipping and len(buffer) - position > max_record_size:
+                    yield _too_large(max_record_size)
+                    skipping = True
+                if skipping:
+                    # it's been reported, so what the scanner has looked at can go
+                    buffer, position, scanner.position = '', 0, 0
+                break   # wait for more data
+            if end - position > max_record_size:
+                if not skipping:
+                    yield _too_large(max_record_size)
+            elif not skipping:
+                # the whole element is there now: it either decodes, or it's malformed
+                yield _decode_element(buffer[position:end])
+            scanner, skipping = None, False
+            position = end
+
+        buffer, position = buffer[position:], 0
+
+    if not finished:
+        yield MalformedRecord("unexpected end of JSON array")
+
+
+async def iter_records(
+        chunks: AsyncIterator[bytes],
+        content_type: str,
+        max_record_size: int = MAX_RECORD_SIZE
+) -> AsyncIterator[Any]:
+    if content_type.split(';')[0].strip() in ('application/x-ndjson', 'application/jsonl'):
+        records = _ndjson_records(chunks, max_record_size)
+    else:
+        records = _json_array_records(chunks, max_record_size)
+    async for record in records:
+        yield record
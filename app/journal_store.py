@@ -0,0 +1,93 @@
+"""
+An indexed store for anything that's looked up by username: the journals, and the basic auth app's users.
+
+Journal.get used to walk every journal in the list and compare usernames one by one, so looking up a user cost O(n)
+in the number of users. Here, journals are kept in a dict keyed by a keyed hash (HMAC-SHA256) of the username, which
+makes lookups O(1).
+
+Why not just key the dict by the raw username?
+    dict lookups compare keys with ==, which bails out on the first mismatched byte. An attacker timing the lookups
+    could use that to learn which usernames exist, one character at a time. The HMAC key is random and private to this
+    process, so the attacker can't predict (let alone control) the digest of the username they send, and the timing
+    of the dict lookup tells them nothing useful. We still finish off with secrets.compare_digest on the username of
+    the matching journal, just like the old linear scan did.
+"""
+
+import hashlib
+import hmac
+import secrets
+from typing import Iterator, Union
+
+from pydantic import BaseModel
+
+
+class UsernameTaken(Exception):
+
+    def __init__(self, username: str):
+        self.username = username
+
+
+class UsernameStore:
+
+    def __init__(self, key: bytes | None = None):
+        # a fresh random key per process. the digests never leave the process, so there's no need to persist it
+        self._key = key or secrets.token_bytes(32)
+        self._entries: dict[bytes, BaseModel] = {}
+
+    def _digest(self, username: str) -> bytes:
+        return hmac.new(self._key, username.encode('utf8'), hashlib.sha256).digest()
+
+    def add(self, entry: BaseModel):
+        # adds a new entry. usernames are unique, so adding an entry for a username that's taken is an error
+        digest = self._digest(entry.username)
+        if digest in self._entries:
+            raise UsernameTaken(entry.username)
+        self._entries[digest] = entry
+
+    def put(self, entry: BaseModel):
+        # inserts the entry, replacing any existing entry with the same username
+        self._entries[self._digest(entry.username)] = entry
+
+    def get(self, username: str) -> Union[BaseModel, None]:
+        entry = self._entries.get(self._digest(username))
+        if entry is None or not secrets.compare_digest(username.encode('utf8'), entry.username.encode('utf8')):
+            return None
+        return entry
+
+    def update(self, username: str, /, **changes) -> Union[BaseModel, None]:
+        # updates fields of an existing entry in place. returns None if there's no entry for the username
+        entry = self.get(username)
+        if entry is None:
+            return None
+
+        new_username = changes.get('username', username)
+        if new_username != username and new_username in self:
+            raise UsernameTaken(new_username)
+
+        for field, value in changes.items():
+            setattr(entry, field, value)
+
+        if new_username != username:
+            # the key is derived from the username, so a rename has to move the entry to its new slot
+            del self._entries[self._digest(username)]
+            self._entries[self._digest(new_username)] = entry
+        return entry
+
+    def delete(self, username: str) -> bool:
+        if self.get(username) is None:
+            return False
+        del self._entries[self._digest(username)]
+        return True
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, username: str) -> bool:
+        return self.get(username) is not None
+
+    def __iter__(self) -> Iterator[BaseModel]:
+        # iterate over a copy so that callers can add/delete entries while iterating
+        return iter(list(self._entries.values()))
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,57 @@
+"""
+Cache of decoded JWTs for the bearer-token path operations.
+
+Clients reuse the same access token for its whole lifetime (API_KEY_TTL, 5 minutes), but without a cache every request
+pays for jwt.decode (signature check + claims validation) and the Journal lookup all over again.
+
+DecodedTokenCache remembers the verified claims and the resolved Journal for each token:
+    - entries are keyed by a SHA-256 digest of the token, never the raw token
+    - each entry expires at the token's own 'exp' claim, so an expired token is never served from the cache. it has to
+      go through jwt.decode again, which raises ExpiredSignatureError like before
+    - the cache is bounded (LRU) and counts hits and misses
+Tokens that fail to decode, or that don't resolve to a Journal, are never cached.
+"""
+
+import hashlib
+import time
+from typing import Any, Callable, Union
+
+from .cache import TTLCache
+
+
+class DecodedTokenCache:
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 300.0):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def resolve(
+            self,
+            token: str,
+            decode: Callable[[str], dict],
+            lookup: Callable[[str], Any]
+    ) -> tuple[dict, Union[Any, None]]:
+        """
+        Returns the (claims, journal) for the token, decoding it and looking the journal up only on a cache miss.
+        :param token: the raw bearer token
+        :param decode: verifies and decodes the token into its claims. errors it raises are passed on to the caller
+        :param lookup: resolves the 'sub' claim to a journal, or None
+        """
+        key = hashlib.sha256(token.encode('utf8')).digest()
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        claims = decode(token)
+        username = claims.get('sub')
+        journal = lookup(username) if username is not None else None
+
+        expiry = claims.get('exp')
+        if journal is not None and isinstance(expiry, (int, float)):
+            self.cache.set(key, (claims, journal), ttl=expiry - time.time())
+        return claims, journal
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
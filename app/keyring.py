@@ -0,0 +1,226 @@
+"""
+Signing keys for the JWTs, parsed once.
+
+jwt.encode(claims, API_KEY, ...) and jwt.decode(token, API_KEY, ...) turn the key string into a key object
+(jwk.construct) on every single call. The Keyring does that once per key and hands jose the ready key objects.
+
+It also makes it possible to have more than one key:
+    - every token says which key signed it, in its 'kid' header. a token is verified with that key and that key's
+      algorithm only (so a token can't pick its own algorithm), and a kid we don't know is rejected
+    - HMAC keys (HS256/384/512) sign and verify with the same secret. RSA (RS256/384/512) and EC (ES256/384/512) keys sign
+      with a private key, and verify with the public key. a node that only has the public keys can verify every token,
+      but can't sign any: that's a verification-only replica, and it never sees a secret. /.well-known/jwks.json serves
+      the public keys, for anyone else who wants to verify our tokens
+    - python-jose 3.3 has no EdDSA (Ed25519). ES256 is the small, fast asymmetric option here
+
+Without X_KEYRING, there's one key: X_API_KEY with X_API_KEY_ALGO, named 'default', same as before. Tokens without a kid
+(made before kids existed) are checked against the 'default' key.
+
+With X_KEYRING, the keys come from a JSON file:
+    {
+        "active": "2026-10",
+        "keys": [
+            {"kid": "2026-10", "alg": "ES256", "private_key_file": "jwt-2026-10.pem"},
+            {"kid": "2026-07", "alg": "ES256", "public_key_file": "jwt-2026-07.pub.pem"},
+            {"kid": "default", "alg": "HS256", "secret_env": "X_API_KEY"}
+        ]
+    }
+    - a key is one of: "secret" or "secret_env" (the name of the env var holding it) for HMAC, "private_key" or
+      "private_key_file" (PEM), or "public_key" or "public_key_file" (PEM, verify only). relative paths are relative to
+      the keyring file
+    - "active" is the key new tokens are signed with. leave it out on verification-only replicas
+
+The file is checked for changes every X_KEYRING_CHECK_EVERY seconds, and reloaded when it changed. A broken file is
+logged and ignored: the keys loaded before stay in use. Rotating to a new key, with no downtime:
+    1. add the new key to the keyring of every node, without making it active. everyone can verify it now
+    2. make it the active key. new tokens are signed with it, and tokens signed with the old key still verify
+    3. once the last token signed with the old key has expired (X_REFRESH_TOKEN_TTL, see refresh_tokens.py), remove it
+
+Config (environment variables):
+    X_KEYRING               path of the keyring file. if not set, X_API_KEY / X_API_KEY_ALGO are the only key
+    X_KEYRING_CHECK_EVERY   seconds between checks for changes to the file. defaults to 5
+"""
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from jose import jwk, jwt, JWTError
+from jose.backends.base import Key
+from jose.constants import ALGORITHMS
+
+from .log import get_logger
+from .metrics import registry
+
+KEYRING_PATH = os.environ.get('X_KEYRING')
+KEYRING_CHECK_EVERY = float(os.environ.get('X_KEYRING_CHECK_EVERY', 5))
+
+log = get_logger(__name__)
+
+# the kid of the X_API_KEY key, and the key that tokens without a kid are checked against
+DEFAULT_KID = 'default'
+
+
+class KeyringError(Exception):
+    # this node can't sign tokens: no active key, or only the public part of it
+    pass
+
+
+@dataclass(frozen=True)
+class SigningKey:
+    kid: str
+    algorithm: str
+    verifier: Key
+    signer: Key | None = None   # None if we only have the public key
+
+    @classmethod
+    def from_config(cls, entry: dict, base_dir: str = '.') -> 'SigningKey':
+        kid, algorithm = entry['kid'], entry['alg']
+        if algorithm not in ALGORITHMS.HMAC | ALGORITHMS.RSA_DS | ALGORITHMS.EC_DS:
+            raise ValueError(f'key {kid!r}: unsupported algorithm {algorithm!r}')
+
+        def read(name: str) -> str | None:
+            if name in entry:
+                return entry[name]
+            if f'{name}_file' in entry:
+                with open(os.path.join(base_dir, entry[f'{name}_file'])) as file:
+                    return file.read()
+            return None
+
+        if algorithm in ALGORITHMS.HMAC:
+            secret = entry['secret'] if 'secret' in entry else os.environ.get(entry.get('secret_env', ''))
+            if not secret:
+                raise ValueError(f'key {kid!r}: HMAC keys need a secret')
+            key = jwk.construct(secret, algorithm)
+            return cls(kid, algorithm, verifier=key, signer=key)
+
+        private_key = read('private_key')
+        if private_key is not None:
+            signer = jwk.construct(private_key, algorithm)
+            return cls(kid, algorithm, verifier=signer.public_key(), signer=signer)
+        public_key = read('public_key')
+        if public_key is None:
+            raise ValueError(f'key {kid!r}: needs a private_key or a public_key')
+        return cls(kid, algorithm, verifier=jwk.construct(public_key, algorithm))
+
+    def public_jwk(self) -> dict | None:
+        # HMAC keys are secret, so they're never published
+        if self.algorithm in ALGORITHMS.HMAC:
+            return None
+        return {**self.verifier.to_dict(), 'kid': self.kid, 'use': 'sig'}
+
+
+@dataclass(frozen=True)
+class KeySet:
+    keys: dict[str, SigningKey]
+    active: SigningKey | None
+
+
+class Keyring:
+
+    def __init__(self, keys: KeySet | None = None, path: str | None = None, check_every: float = KEYRING_CHECK_EVERY):
+        self.path = path
+        self.check_every = check_every
+        self._lock = threading.Lock()
+        self._file_key = None
+        self._next_check = 0.0
+        self._keys = keys if keys is not None else KeySet({}, None)
+        self.reloads = 0
+        self.reload_errors = 0
+        self.unknown_kids = 0
+        if path is not None:
+            self._check_file(force=True)
+
+    @classmethod
+    def from_env(cls) -> 'Keyring':
+        if KEYRING_PATH:
+            return cls(path=KEYRING_PATH)
+        key = SigningKey.from_config({
+            'kid': DEFAULT_KID, 'alg': os.environ['X_API_KEY_ALGO'], 'secret': os.environ['X_API_KEY']
+        })
+        return cls(KeySet({key.kid: key}, key))
+
+    @staticmethod
+    def load(path: str) -> KeySet:
+        with open(path) as file:
+            config = json.load(file)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        keys = {}
+        for entry in config['keys']:
+            key = SigningKey.from_config(entry, base_dir)
+            keys[key.kid] = key
+        active = config.get('active')
+        if active is not None and active not in keys:
+            raise ValueError(f'active key {active!r} is not in the keyring')
+        return KeySet(keys, keys[active] if active is not None else None)
+
+    def _check_file(self, force: bool = False):
+        # a stat() every check_every seconds. the file is only read and parsed when it changed
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        with self._lock:
+            if not force and now < self._next_check:
+                return
+            self._next_check = now + self.check_every
+            try:
+                stat_result = os.stat(self.path)
+                file_key = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+                if file_key == self._file_key:
+                    return
+                self._keys = self.load(self.path)
+                self._file_key = file_key
+                self.reloads += 1
+            except Exception as e:
+                if force:   # at startup there are no keys to fall back on
+                    raise
+                self.reload_errors += 1
+                log.error('keyring reload failed. keeping the keys loaded before', error=str(e))
+
+    @property
+    def keys(self) -> KeySet:
+        if self.path is not None:
+            self._check_file()
+        return self._keys
+
+    def encode(self, claims: dict) -> str:
+        active = self.keys.active
+        if active is None or active.signer is None:
+            raise KeyringError('no signing key on this node')
+        return jwt.encode(claims, active.signer, active.algorithm, headers={'kid': active.kid})
+
+    def decode(self, token: str) -> dict:
+        # raises JWTError (or ExpiredSignatureError, one of its subclasses), just like jwt.decode
+        kid = jwt.get_unverified_header(token).get('kid', DEFAULT_KID)
+        # the header isn't verified yet, so kid can be anything. a list or a dict can't even be looked up in a dict
+        key = self.keys.keys.get(kid) if isinstance(kid, str) else None
+        if key is None:
+            self.unknown_kids += 1
+            raise JWTError('Unknown key id')
+        return jwt.decode(token, key.verifier, algorithms=[key.algorithm])
+
+    def jwks(self) -> dict:
+        return {'keys': [jwk for key in self.keys.keys.values() if (jwk := key.public_jwk()) is not None]}
+
+    def stats(self) -> dict:
+        keys = self._keys
+        return {
+            'keys': len(keys.keys),
+            'can_sign': int(keys.active is not None and keys.active.signer is not None),
+            'reloads': self.reloads,
+            'reload_errors': self.reload_errors,
+            'unknown_kids': self.unknown_kids,
+        }
+
+
+# one keyring shared by every app in the process
+keyring = Keyring.from_env()
+registry.register_stats('keyring', keyring.stats)
+
+
+async def keyring_error_handler(request: Request, e: KeyringError):
+    return JSONResponse({"detail": "This server can't issue tokens"}, status_code=503)
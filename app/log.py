@@ -0,0 +1,226 @@
+"""
+Structured logging that doesn't block requests.
+
+print() writes to stdout right there in the request, and if the terminal or the pipe behind stdout is slow, so is the
+request. Some of those prints also wrote raw passwords and tokens to the logs.
+
+Instead, every module gets a logger from get_logger(__name__) and logs events with fields:
+    log.info('login attempt', username=username)
+
+What happens to that call:
+    - sampling: below WARNING, each logger only keeps a fraction of its records (X_LOG_SAMPLE). the rest are dropped
+      before a log record is even created. warnings and errors are always kept
+    - redaction: fields whose name looks secret (password, token, secret, ...) are replaced with '[redacted]', also
+      inside nested dicts and pydantic models, so they never reach the queue, let alone the output. that's a backstop
+      for secrets that come along inside something else (a model, say): don't pass them to the logger on purpose
+    - the record is put on a bounded in-memory queue. that's all the request pays for. if the queue is full, the record
+      is dropped (and counted) rather than making the request wait
+    - a background thread (logging.handlers.QueueListener) takes records off the queue, formats them as one JSON object
+      per line (or as plain text), and writes them to stdout
+
+Config (environment variables):
+    X_LOG_LEVEL         DEBUG, INFO (default), WARNING, ...
+    X_LOG_FORMAT        'json' (default) or 'text'
+    X_LOG_SAMPLE        per-logger sample rates, e.g. 'main=0.1,more=0.01'. loggers not listed keep everything
+    X_LOG_REDACT        extra field names to redact, comma separated
+    X_LOG_QUEUE_SIZE    max records waiting to be written. defaults to 10000
+"""
+
+import atexit
+import dataclasses
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from pydantic import BaseModel
+
+from .metrics import registry
+
+LOG_LEVEL = os.environ.get('X_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('X_LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.environ.get('X_LOG_QUEUE_SIZE', 10_000))
+
+# a field is redacted if its name contains any of these
+REDACTED_KEYS = {'password', 'token', 'secret', 'salt', 'authorization', 'api_key', 'sec_key'} | {
+    key.strip().lower() for key in os.environ.get('X_LOG_REDACT', '').split(',') if key.strip()
+}
+REDACTED = '[redacted]'
+
+# our loggers all live under this one, so the handler below doesn't touch uvicorn's (or anyone else's) logging
+ROOT_LOGGER = 'app'
+
+
+def _parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in spec.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_sample_rates(os.environ.get('X_LOG_SAMPLE', ''))
+
+
+def redact(value, key: str = ''):
+    """
+    Returns a copy of value that's safe to log: secret-looking keys are redacted, and pydantic models and dataclasses
+    are turned into dicts (and redacted too).
+    """
+    key = key.lower()
+    if key and any(secret in key for secret in REDACTED_KEYS):
+        return REDACTED
+    if isinstance(value, BaseModel):
+        value = value.model_dump(mode='json')
+    elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+        value = dataclasses.asdict(value)
+    if isinstance(value, dict):
+        return {k: redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [redact(v) for v in value]
+    return value
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    Takes the event's fields as keyword arguments, samples, and redacts the fields before anything is queued.
+    """
+
+    _logging_kwargs = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = 1.0):
+        super().__init__(logger, {})
+        self.sample_rate = sample_rate
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.isEnabledFor(level):
+            return
+        if level < logging.WARNING and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        super().log(level, msg, *args, **kwargs)
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in self._logging_kwargs}
+        if fields:
+            kwargs['extra'] = {**kwargs.get('extra', {}), 'fields': redact(fields)}
+        return msg, kwargs
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value!r}' for key, value in fields.items())
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks: if the queue is full, the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepare formats the whole record here, in the request's thread. we only do what has to happen
+        # here (merging args into the message, and rendering the traceback while it's still around), and leave the
+        # formatting to the listener's thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingPipeline:
+
+    def __init__(self, queue_size: int = LOG_QUEUE_SIZE, fmt: str = LOG_FORMAT, level: str = LOG_LEVEL):
+        self.queue_size = queue_size
+        self.formatter = JSONFormatter() if fmt == 'json' else TextFormatter()
+        self.logger = logging.getLogger(ROOT_LOGGER)
+        self.logger.setLevel(level)
+        self.logger.propagate = False
+        self.handler: DroppingQueueHandler | None = None
+        self.listener: QueueListener | None = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.listener is not None:
+                return
+            log_queue = queue.Queue(maxsize=self.queue_size)
+            output = logging.StreamHandler(sys.stdout)
+            output.setFormatter(self.formatter)
+
+            self.handler = DroppingQueueHandler(log_queue)
+            self.logger.handlers = [self.handler]
+            self.listener = QueueListener(log_queue, output, respect_handler_level=True)
+            self.listener.start()
+
+    def stop(self):
+        # writes out whatever is still queued
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def _after_fork(self):
+        # the listener's thread doesn't survive a fork. the child gets its own queue and thread
+        self.listener = None
+        self._lock = threading.Lock()
+        self.start()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.handler.queue.qsize() if self.handler else 0,
+            'dropped': self.handler.dropped if self.handler else 0,
+        }
+
+
+pipeline = LoggingPipeline()
+pipeline.start()
+atexit.register(pipeline.stop)
+os.register_at_fork(after_in_child=pipeline._after_fork)
+registry.register_stats('logging', pipeline.stats)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    # get_logger(__name__). 'app.main' and 'main' (when run from inside app/) both end up as the 'app.main' logger
+    short_name = name.rsplit('.', 1)[-1]
+    logger = logging.getLogger(ROOT_LOGGER).getChild(short_name)
+    return StructuredLogger(logger, SAMPLE_RATES.get(short_name, 1.0))
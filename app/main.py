@@ -1,19 +1,39 @@
+import os
+import stat
+import mimetypes
+from urllib.parse import quote
 from fastapi import (
     FastAPI, Query, Path,
     Body, Cookie, Header,
     Request, Response, Form, HTTPException, Depends
 )
-from fastapi.responses import RedirectResponse, FileResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi.responses import RedirectResponse, FileResponse, StreamingResponse
 from typing import Annotated, Any
-from enum import Enum
-from datetime import date
+from contextlib import asynccontextmanager
 
-from pydantic import BaseModel, Field, HttpUrl, EmailStr
+from pydantic import BaseModel, HttpUrl, TypeAdapter, ValidationError
+from starlette.concurrency import run_in_threadpool
+import anyio
+
+from .models import Title, BaseRecruit, SecureRecruit, Recruit
+from .pagination import Page, paginate_after, ndjson_lines, InvalidCursor
+from .ingest import iter_records, MalformedRecord
+from .prerendered import PrerenderedPage
+from .static_cache import StaticAsset, etag_for, not_modified
+from .file_responses import FileStreamResponse, RangeNotSatisfiable, parse_range, safe_join
+from .metrics import install_metrics
+from .compression import install_compression
+from .fast_json import FastJSONResponse, json_response
+from .log import get_logger
+from .storage import RecruitSnapshot
+from .etags import version_etag, etag_matches, etag_headers, not_modified_response
+
+# structured, queued logging. see log.py
+log = get_logger(__name__)
 
 
 def security_token_verifier(sec_token: Annotated[str, Header(alias='X-Sec-Token')]):
-    print("token: ", sec_token)
+    log.debug('security token received')
     if sec_token != 'hash#1234':
         raise SecException('invalid access token')
 
@@ -26,37 +46,18 @@ def secret_key_verifier(sec_key: Annotated[str, Header(alias='X-Sec-Key')]):
 SecurityTokenVerifier = Depends(security_token_verifier)
 SecretKeyVerifier = Depends(secret_key_verifier)
 
-app = FastAPI()
-
-
-class Title(Enum):
-    CHIEF = 'ceo'
-    OPERATIONS = 'coo'
-    TECH = 'cto'
-
-
-class BaseRecruit(BaseModel):
-    name: str
-    email: EmailStr
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    Recruit.preload_recruits_from_db_to_cache()
+    yield
+    Recruit.clear_cache()
 
-class SecureRecruit(BaseRecruit):
-    password: str
 
-
-class Recruit(BaseRecruit):
-    linked_in: HttpUrl | None = None
-    total_comp: int = Field(gt=50000, default=70000)
-    start_date: date | None = Field(default_factory=date.today)
-    __recruits__: list['Recruit'] = []
-
-    @classmethod
-    def add_recruit(cls, recruit: 'Recruit'):
-        cls.__recruits__.append(recruit)
-
-    @classmethod
-    def all(cls):
-        return cls.__recruits__
+# JSON is rendered with pydantic_core instead of json.dumps. see fast_json.py
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+install_compression(app, 'main')
+install_metrics(app, 'main')
 
 
 @app.get("/team/ceo", tags=['team'], summary='ceo')
@@ -77,9 +78,52 @@ async def get_team_member(title: Annotated[Title, Query()] = None):
     }
 
 
+# files under this directory can be downloaded through /download/{file}
+DOWNLOAD_ROOT = os.environ.get('X_DOWNLOAD_ROOT', os.path.join(os.path.dirname(__file__), 'downloads'))
+
+
 @app.get("/download/{file:path}")
-async def download(file: str):
-    return file
+async def download(file: str, request: Request):
+    """
+    Serves a file from DOWNLOAD_ROOT, without ever loading it into memory.
+    Supports Range requests (206 Partial Content), so interrupted downloads can be resumed, and conditional requests
+    (If-None-Match / If-Modified-Since).
+    """
+    path = safe_join(DOWNLOAD_ROOT, file)
+    if path is None:
+        raise NFException(file)
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise NFException(file)
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise NFException(file)
+
+    etag = etag_for(stat_result)
+    headers = {
+        'ETag': etag,
+        'Content-Disposition': f"attachment; filename*=utf-8''{quote(os.path.basename(path))}",
+    }
+    if not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    # If-Range: only honour the Range header if the client's copy is still the current one
+    if_range = request.headers.get('if-range')
+    range_header = request.headers.get('range') if if_range in (None, etag) else None
+    try:
+        byte_range = parse_range(range_header, stat_result.st_size)
+    except RangeNotSatisfiable as e:
+        return Response(status_code=416, headers={'Content-Range': f'bytes */{e.size}'})
+
+    if byte_range is None:
+        return FileStreamResponse(path, stat_result, headers=headers, media_type=media_type)
+
+    offset, length = byte_range
+    return FileStreamResponse(
+        path, stat_result, status_code=206, headers=headers, media_type=media_type, offset=offset, length=length
+    )
 
 
 @app.post('/team/hire/{app_ac_name}',
@@ -104,22 +148,146 @@ def recruit(
         return {
             "sorry": f"{app_ac_name}: Inadequate experience"
         }
-    Recruit.add_recruit(member)
+    member_id = Recruit.add_recruit(member)
     return {
+        "member_id": member_id,
         "member": member,
         "experience": f"{experience_yrs} years",
         "experiences": experiences
     }
 
 
-@app.get('/team/recruits', tags=['team'])
-def get_recruits() -> list[BaseRecruit]:
-    return Recruit.all()
+class HireResult(BaseModel):
+    index: int
+    accepted: bool
+    member_id: int | None = None
+    errors: list[dict] | None = None
+
+
+recruit_adapter = TypeAdapter(Recruit)
+HIRE_CHUNK_SIZE = 500
+
+
+def hire_chunk(records: list[tuple[int, Any]]) -> list[HireResult]:
+    # validates a chunk of records and adds the valid ones to the store in one batch.
+    # runs in the threadpool, so validation and the db write don't hold up the event loop
+    results = []
+    accepted = []
+    for index, record in records:
+        if isinstance(record, MalformedRecord):
+            results.append(HireResult(index=index, accepted=False, errors=[{'msg': record.detail}]))
+            continue
+        try:
+            accepted.append(recruit_adapter.validate_python(record))
+        except ValidationError as e:
+            errors = [{'loc': error['loc'], 'msg': error['msg'], 'type': error['type']} for error in e.errors()]
+            results.append(HireResult(index=index, accepted=False, errors=errors))
+        else:
+            results.append(HireResult(index=index, accepted=True))
+
+    if accepted:
+        member_ids = iter(Recruit.add_recruits(accepted))
+        for result in results:
+            if result.accepted:
+                result.member_id = next(member_ids)
+    return results
+
+
+@app.post('/team/hire/{app_ac_name}/bulk',
+          tags=['team'],
+          summary="we're hiring, in bulk",
+          description="send recruits as NDJSON (application/x-ndjson) or as a JSON array. "
+                      "the body is read and validated as it streams in, a chunk at a time"
+          )
+async def recruit_bulk(
+        request: Request,
+        app_ac_name: Annotated[str, Path(min_length=3, max_length=7)]
+) -> list[HireResult]:
+    # every record gets a result, in order. records that are malformed or too large are rejected one by one, like the
+    # ones that don't validate, so a bad record never undoes (or hides) the chunks that were already hired
+    results = []
+    chunk = []
+    index = 0
+    async for record in iter_records(request.stream(), request.headers.get('content-type', '')):
+        chunk.append((index, record))
+        index += 1
+        if len(chunk) >= HIRE_CHUNK_SIZE:
+            results.extend(await run_in_threadpool(hire_chunk, chunk))
+            chunk = []
+
+    if chunk:
+        results.extend(await run_in_threadpool(hire_chunk, chunk))
+    return results
+
+
+base_recruit_adapter = TypeAdapter(BaseRecruit)
+base_recruits_adapter = TypeAdapter(tuple[BaseRecruit, ...])
+base_recruit_list_adapter = TypeAdapter(list[BaseRecruit])
+recruits_page_adapter = TypeAdapter(Page[BaseRecruit])
+
+
+def recruits_etag(snapshot: RecruitSnapshot) -> str:
+    # the snapshot's version is the version of exactly the recruits in it. see etags.py
+    return version_etag(Recruit.database(), 'r', snapshot.version)
+
+
+@app.get('/team/recruits', tags=['team'], response_model=list[BaseRecruit])
+def get_recruits(request: Request) -> Response:
+    # dashboards poll this. if nobody was hired or changed since their last poll, they get a 304 and no body
+    snapshot = Recruit.snapshot()
+    etag = recruits_etag(snapshot)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    # the whole roster goes straight from the models to JSON bytes, without a dict per recruit in between
+    return json_response(snapshot.recruits, base_recruits_adapter, headers=etag_headers(etag))
+
+
+@app.get('/team/recruits/page', tags=['team'], response_model=Page[BaseRecruit])
+def get_recruits_page(
+        request: Request,
+        limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+        cursor: Annotated[str | None, Query(description='next_cursor from the previous page')] = None
+) -> Response:
+    # the cursor holds the member id of the last recruit on the previous page, so hiring doesn't shift pages around
+    snapshot = Recruit.snapshot()
+    # the cursor is checked first: a bad one is a 400, whatever the client has cached
+    try:
+        items, next_cursor = paginate_after(snapshot.ids, snapshot.recruits, cursor, limit)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    # limit and cursor are in the URL, and an ETag only ever gets compared with ones from the same URL
+    etag = recruits_etag(snapshot)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    return json_response(
+        Page[BaseRecruit](items=items, next_cursor=next_cursor), recruits_page_adapter, headers=etag_headers(etag)
+    )
+
+
+@app.get('/team/recruits/stream', tags=['team'], response_class=StreamingResponse)
+def stream_recruits():
+    # one recruit per line (NDJSON), serialized as the response is being sent. memory use stays flat no matter how big
+    # the roster gets
+    return StreamingResponse(ndjson_lines(Recruit.all(), base_recruit_adapter), media_type='application/x-ndjson')
 
 
 @app.put("/team/change-tc/{member_id}", tags=['team'])
-def change_total_comp(member_id: int, total_comp: Annotated[int, Body(embed=True)]):
-    Recruit.__recruits__[member_id].total_comp = total_comp
+def change_total_comp(member_id: int, total_comp: Annotated[int, Body(embed=True, gt=50000)]):
+    if Recruit.update(member_id, total_comp=total_comp) is None:
+        raise HTTPException(status_code=404, detail='No such member')
+
+
+@app.get('/team/recruits/{member_id}', tags=['team'], response_model=BaseRecruit)
+def get_recruit(request: Request, member_id: int) -> Response:
+    # member ids are the ones returned when hiring. they don't change as others are hired
+    snapshot = Recruit.snapshot()
+    recruit = snapshot.get(member_id)
+    if recruit is None:
+        raise HTTPException(status_code=404, detail='No such member')
+    etag = recruits_etag(snapshot)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    return json_response(recruit, base_recruit_adapter, headers=etag_headers(etag))
 
 
 @app.post("/arbitrary-body")
@@ -149,17 +317,19 @@ def teleport(url: HttpUrl | None = None):
     return RedirectResponse(url or 'https://google.com')
 
 
-@app.get('/xml')
-def get_xml():
-    content = """
+xml_page = PrerenderedPage("""
     <b>
     TGC
     </b>
     <em>
     $100B
     </em>
-    """
-    return Response(content, media_type='text/html', headers={'CEO': 'tgc'})
+    """, headers={'CEO': 'tgc'})
+
+
+@app.get('/xml')
+def get_xml(request: Request):
+    return xml_page.response(request)
 
 
 @app.get('/genders', response_model=dict[str, Any])
@@ -176,27 +346,31 @@ def not_found():
     raise HTTPException(status_code=404, headers={'not': 'found'}, detail="NF")
 
 
-def parse_login_page():
+# read once and kept in memory. reloaded only if the file changes on disk. see static_cache.py
+login_page = StaticAsset(os.path.join(os.path.dirname(__file__), 'page.html'), media_type='text/html')
+
+
+def parse_login_page(request: Request):
     try:
-        with open('page.html', 'r') as page:
-            yield page.read()
+        # a 304 if the client's copy is still fresh, otherwise the page itself
+        yield login_page.response(request)
     except FileNotFoundError as e:
-        print("Error occurred holmes: ", e)
+        log.warning('login page not found', error=str(e))
         raise NFException("no page found")
     except SecException:
-        print("no clearance bud")
+        log.info('no clearance bud')
     finally:
-        print("response sent to client")
+        log.debug('response sent to client')
 
 
 @app.get('/team/log-in', tags=['team'])
-def get_login_page(content: Annotated[str, Depends(parse_login_page)]):
-    return Response(content, media_type='text/html')
+def get_login_page(page: Annotated[Any, Depends(parse_login_page)]):
+    return page
 
 
 @app.post('/login', dependencies=[SecurityTokenVerifier, SecretKeyVerifier])
 def log_in(username: Annotated[str, Form()], password: Annotated[str, Form()]):
-    print("password: ", password)
+    log.info('log in', username=username)
     response = f"""
     <html>
     Welcome {username}!
@@ -221,9 +395,7 @@ class SecException(Exception):
         self.detail = detail
 
 
-@app.exception_handler(NFException)
-def nf_exception_handler(request: Request, e: NFException):
-    content = """<html lang="en">
+ERROR_PAGE_HEAD = """<html lang="en">
         <head>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
@@ -251,57 +423,37 @@ def nf_exception_handler(request: Request, e: NFException):
                     font-size: 18px;
                 }
             </style>
-        </head>""" + f"""<body>
+        </head>"""
+
+# the error pages are rendered once, when the module loads. handlers only splice in the dynamic bits.
+# see prerendered.py
+not_found_page = PrerenderedPage(ERROR_PAGE_HEAD + """<body>
             <div class="container">
                 <h1>404 Not Found</h1>
                 <p>Sorry, we couldn't find the page you're requesting</p>
                 <p><a href="/team/log-in">Go back to the home page</a></p>
             </div>
         </body>
-        </html>"""
-    return Response(content, media_type='text/html', status_code=404)
+        </html>""", status_code=404)
 
-
-@app.exception_handler(SecException)
-def security_exception_handler(request: Request, e: SecException):
-    content = """<html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>404 Not Found</title>
-            <style>
-                body {
-                    font-family: Arial, sans-serif;
-                    background-color: #f4f4f4;
-                    color: #333;
-                    text-align: center;
-                    padding: 50px;
-                    margin: 0;
-                }
-        
-                .container {
-                    max-width: 600px;
-                    margin: 0 auto;
-                }
-        
-                h1 {
-                    color: #e44d26;
-                }
-        
-                p {
-                    font-size: 18px;
-                }
-            </style>
-        </head>""" + f"""<body>
+security_error_page = PrerenderedPage(ERROR_PAGE_HEAD + """<body>
             <div class="container">
                 <h1>400 Security Error</h1>
-                <p>Invalid authentication: {e.detail}</p>
+                <p>Invalid authentication: {detail}</p>
                 <p><a href="/team/log-in">Go back to the home page</a></p>
             </div>
         </body>
-        </html>"""
+        </html>""", fields=('detail',), status_code=400)
+
+
+@app.exception_handler(NFException)
+def nf_exception_handler(request: Request, e: NFException):
+    return not_found_page.response(request)
+
 
-    return Response(content, status_code=400)
+@app.exception_handler(SecException)
+def security_exception_handler(request: Request, e: SecException):
+    return security_error_page.response(request, detail=str(e.detail))
 
 
 @app.get('/search')
@@ -311,8 +463,7 @@ def search(query: str):
 
 @app.post("/json")
 def json_enc(p: list[BaseRecruit]):
-    foo = jsonable_encoder(p)
-    # bar = p.model_dump()
-    print(type(foo), foo)
-    # print(type(bar), bar)
+    # straight to JSON bytes. jsonable_encoder(p) would build a dict per recruit first
+    encoded = base_recruit_list_adapter.dump_json(p)
+    log.debug('encoded recruits', type=type(encoded).__name__, size=len(encoded))
 
@@ -0,0 +1,233 @@
+"""
+Low-overhead request metrics, exposed in the Prometheus text format at /metrics.
+
+MetricsMiddleware is a plain ASGI middleware. @app.middleware('http') (BaseHTTPMiddleware) wraps every response in
+extra tasks and streams, which costs more than the timing itself. This one just wraps `send`:
+    - latency is measured with time.perf_counter_ns, from the request coming in to the last body chunk going out, and
+      recorded in a histogram per (app, method, route)
+    - responses are counted per status code, and response body bytes are summed per route
+    - a gauge tracks how many requests are in flight
+    - an X-Proc-Time header (milliseconds, with microsecond precision) is added to every response, as before
+
+Routes are labelled by their path template ('/journal/{username}', not '/journal/foo'), so the number of series stays
+bounded. That goes for plain starlette routes too (/metrics). Requests that don't match any route are labelled
+'<unmatched>'.
+
+Other parts of the app (the hashing pool, caches, queues) can publish their own numbers with
+registry.register_collector or registry.register_stats.
+
+Usage:
+    install_metrics(app, 'main')
+"""
+
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# seconds. prometheus' defaults, with a few finer buckets at the low end
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+# (name, type, help, [(labels, value), ...])
+Collected = tuple[str, str, str, Iterable[tuple[dict[str, str], float]]]
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+
+    def dec(self, labels: Labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # per label set: [count per bucket (the last one is +Inf)], sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, labels: Labels, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+
+def _format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+        self.collectors: list[Callable[[], Iterable[Collected]]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        metric = Gauge(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[Collected]]):
+        # the collector is called on every scrape, and returns the current values of whatever it measures
+        self.collectors.append(collector)
+
+    def register_stats(self, prefix: str, stats: Callable[[], dict], labels: dict[str, str] | None = None):
+        # publishes every number in the dict returned by stats() as a gauge named <prefix>_<key>
+        labels = labels or {}
+
+        def collect():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield f'{prefix}_{key}', 'gauge', f'{prefix} {key}', [(labels, value)]
+
+        self.register_collector(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} histogram')
+                for labels, (counts, total) in list(metric.values.items()):
+                    cumulative = 0
+                    for bound, count in zip((*metric.buckets, float('inf')), counts):
+                        cumulative += count
+                        bucket_labels = _format_labels((*labels, ('le', _format_value(bound))))
+                        lines.append(f'{metric.name}_bucket{bucket_labels} {cumulative}')
+                    lines.append(f'{metric.name}_sum{_format_labels(labels)} {_format_value(total[0])}')
+                    lines.append(f'{metric.name}_count{_format_labels(labels)} {cumulative}')
+            else:
+                kind = 'gauge' if isinstance(metric, Gauge) else 'counter'
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {kind}')
+                for labels, value in list(metric.values.items()):
+                    lines.append(f'{metric.name}{_format_labels(labels)} {_format_value(value)}')
+
+        # several collectors can report the same metric (e.g. one per app), but each metric gets one HELP/TYPE header
+        collected: dict[str, tuple[str, str, list]] = {}
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                collected.setdefault(name, (kind, help, []))[2].extend(samples)
+        for name, (kind, help, samples) in collected.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels.items())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# one registry per process, shared by every app in it. series are told apart by the 'app' label
+registry = Registry()
+
+request_duration = registry.histogram('http_request_duration_seconds', 'Time spent serving HTTP requests')
+requests_total = registry.counter('http_requests_total', 'HTTP requests served, by status code')
+requests_in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests currently being served')
+response_bytes = registry.counter('http_response_bytes_total', 'HTTP response body bytes sent')
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app: ASGIApp, app_name: str = 'app'):
+        self.app = app
+        self.app_name = app_name
+        self._app_labels = (('app', app_name),)
+        self._plain_routes: dict[Callable, str] | None = None    # endpoint -> path. filled on the first request
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter_ns()
+        status = 500
+        sent_bytes = 0
+        requests_in_flight.inc(self._app_labels)
+
+        async def send_wrapper(message: Message):
+            nonlocal status, sent_bytes
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                elapsed_ms = (time.perf_counter_ns() - start) / 1_000_000
+                message.setdefault('headers', [])
+                message['headers'] = [*message['headers'], (b'x-proc-time', f'{elapsed_ms:.3f} milliseconds'.encode())]
+            elif message['type'] == 'http.response.body':
+                sent_bytes += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = (time.perf_counter_ns() - start) / 1_000_000_000
+            requests_in_flight.dec(self._app_labels)
+
+            labels = (('app', self.app_name), ('method', scope['method']), ('route', self._route_path(scope)))
+            request_duration.observe(labels, elapsed)
+            requests_total.inc((*labels, ('status', str(status))))
+            response_bytes.inc(labels, sent_bytes)
+
+    def _route_path(self, scope: Scope) -> str:
+        # FastAPI's routes record themselves in the scope on the router's way down. plain starlette routes (the ones
+        # added with add_route, like /metrics itself) only leave their endpoint, so those are looked up by endpoint
+        route = scope.get('route')
+        if route is not None:
+            return getattr(route, 'path_format', None) or route.path
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return '<unmatched>'
+        if self._plain_routes is None:
+            app = scope.get('app')
+            self._plain_routes = {
+                route.endpoint: route.path for route in getattr(app, 'routes', ()) if isinstance(route, Route)
+            }
+        return self._plain_routes.get(endpoint, '<unmatched>')
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def install_metrics(app: FastAPI, app_name: str, path: str = '/metrics'):
+    # adds the middleware to the app, and the endpoint that exposes everything in the registry
+    app.add_middleware(MetricsMiddleware, app_name=app_name)
+    app.add_route(path, metrics_endpoint, include_in_schema=False)
@@ -0,0 +1,80 @@
+"""
+The team models, shared by main.py, dough.py and more.py.
+
+They used to live in main.py, so importing SecureRecruit from there built the whole main app (every route, the pages,
+the download root...) as a side effect. Here they're just models.
+"""
+
+from datetime import date
+from enum import Enum
+from typing import Union
+
+from pydantic import BaseModel, Field, HttpUrl, EmailStr
+
+from .storage import CachedRecruits, Database, RecruitSnapshot
+
+
+class Title(Enum):
+    CHIEF = 'ceo'
+    OPERATIONS = 'coo'
+    TECH = 'cto'
+
+
+class BaseRecruit(BaseModel):
+    name: str
+    email: EmailStr
+
+
+class SecureRecruit(BaseRecruit):
+    password: str
+
+
+class Recruit(BaseRecruit):
+    linked_in: HttpUrl | None = None
+    total_comp: int = Field(gt=50000, default=70000)
+    start_date: date | None = Field(default_factory=date.today)
+    __recruits__: CachedRecruits     # backed by the 'recruits' table. set up right below the class
+
+    @classmethod
+    def add_recruit(cls, recruit: 'Recruit') -> int:
+        # returns the new recruit's member id
+        return cls.__recruits__.add(recruit)
+
+    @classmethod
+    def add_recruits(cls, recruits: list['Recruit']) -> list[int]:
+        # adds them all in one transaction
+        return cls.__recruits__.add_many(recruits)
+
+    @classmethod
+    def all(cls) -> tuple['Recruit', ...]:
+        return cls.__recruits__.all()
+
+    @classmethod
+    def snapshot(cls) -> RecruitSnapshot:
+        # every recruit and their ids, as of now. safe to iterate over while other requests hire. see storage.py
+        return cls.__recruits__.snapshot()
+
+    @classmethod
+    def database(cls) -> Database:
+        # where the recruits are kept. the ETags are made from its instance id. see etags.py
+        return cls.__recruits__.db
+
+    @classmethod
+    def get(cls, member_id: int) -> Union['Recruit', None]:
+        return cls.__recruits__.get(member_id)
+
+    @classmethod
+    def update(cls, member_id: int, /, **changes) -> Union['Recruit', None]:
+        # None if there's no such member
+        return cls.__recruits__.update(member_id, **changes)
+
+    @classmethod
+    def preload_recruits_from_db_to_cache(cls):
+        cls.__recruits__.load()
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__recruits__.clear()
+
+
+Recruit.__recruits__ = CachedRecruits(Recruit)
@@ -3,11 +3,20 @@ from pydantic import EmailStr
 from typing import Annotated
 from datetime import date
 
-from main import SecureRecruit, BaseRecruit
+from .models import SecureRecruit, BaseRecruit
 from dataclasses import dataclass
 
+from .metrics import install_metrics
+from .compression import install_compression
+from .log import get_logger
+from .fast_json import FastJSONResponse
 
-app = FastAPI()
+log = get_logger(__name__)
+
+
+app = FastAPI(default_response_class=FastJSONResponse)
+install_compression(app, 'more')
+install_metrics(app, 'more')
 
 
 def get_recruit_info(name: str, email: EmailStr, password: str):
@@ -29,9 +38,10 @@ def get_user_info(recruit: AuthorizedRecruit):
 
 @app.get('/dining-dollars/{when}')
 def get_dining_balance(when: date, recruit: Annotated[AuthorizedRecruit, Depends()]):
-    print(recruit)
-    return {
+    log.info('dining balance requested', recruit=recruit)     # password and token are redacted
+    # returning the response ourselves skips jsonable_encoder. the date and the model are serialized by pydantic_core
+    return FastJSONResponse({
         "balance": 548,
         "as_of": when,
         "user_info": BaseRecruit(**recruit.__dict__)
-    }
+    })
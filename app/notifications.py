@@ -0,0 +1,221 @@
+"""
+Outbound email, without blocking the server.
+
+Emails are put on an in-process queue and sent by a few background worker tasks:
+    - each worker takes up to `batch_size` queued messages at a time and sends them all over a single SMTP connection,
+      instead of connecting once per message
+    - the blocking smtplib calls run in a thread (asyncio.to_thread), so the event loop keeps serving requests
+    - messages that fail are retried with exponential backoff, up to `max_attempts` times, and then dropped
+    - start() and stop() are meant to be called from the app's lifespan. stop() waits (up to a timeout) for the queue
+      to drain before cancelling the workers
+
+Config (environment variables):
+    X_SMTP_HOST, X_SMTP_PORT        where to send mail. defaults to localhost:1025, e.g. a local SMTP sink like
+                                    `python -m aiosmtpd -n -l localhost:1025`
+    X_SMTP_SENDER                   the From address
+    X_SMTP_USERNAME, X_SMTP_PASSWORD  optional login
+    X_SMTP_STARTTLS                 set to 1 to upgrade the connection with STARTTLS
+    X_EMAIL_WORKERS                 number of sender workers. defaults to 2
+"""
+
+import asyncio
+import os
+import smtplib
+from dataclasses import dataclass
+from email.message import EmailMessage as MIMEMessage
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass
+class EmailMessage:
+    to: str
+    subject: str
+    body: str
+    attempts: int = 0
+
+
+class SMTPTransport:
+
+    def __init__(
+            self,
+            host: str = 'localhost',
+            port: int = 1025,
+            sender: str = 'noreply@localhost',
+            username: str | None = None,
+            password: str | None = None,
+            starttls: bool = False,
+            timeout: float = 10.0
+    ):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls) -> 'SMTPTransport':
+        return cls(
+            host=os.environ.get('X_SMTP_HOST', 'localhost'),
+            port=int(os.environ.get('X_SMTP_PORT', 1025)),
+            sender=os.environ.get('X_SMTP_SENDER', 'noreply@localhost'),
+            username=os.environ.get('X_SMTP_USERNAME'),
+            password=os.environ.get('X_SMTP_PASSWORD'),
+            starttls=os.environ.get('X_SMTP_STARTTLS') == '1'
+        )
+
+    def send_batch(self, messages: list[EmailMessage]) -> list[EmailMessage]:
+        # blocking. sends all the messages over one connection and returns the ones that failed.
+        # if we can't even connect, they all failed
+        try:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        except OSError:
+            return messages
+
+        failed = []
+        done = 0    # how many messages have been dealt with (sent, or failed on their own)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password or '')
+
+            for message in messages:
+                mime = MIMEMessage()
+                mime['From'] = self.sender
+                mime['To'] = message.to
+                mime['Subject'] = message.subject
+                mime.set_content(message.body)
+                try:
+                    smtp.send_message(mime)
+                except smtplib.SMTPException:
+                    failed.append(message)
+                done += 1
+        except (smtplib.SMTPException, OSError):
+            # the connection broke half way. the messages sent before that were delivered, and retrying them would send
+            # duplicates. only the ones not sent yet count as failed
+            failed.extend(messages[done:])
+        finally:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        return failed
+
+
+class EmailQueue:
+
+    def __init__(
+            self,
+            transport: SMTPTransport,
+            workers: int = 2,
+            batch_size: int = 20,
+            max_attempts: int = 5,
+            backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            maxsize: int = 10000
+    ):
+        self.transport = transport
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.maxsize = maxsize
+
+        self._queue: asyncio.Queue[EmailMessage] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._retries: set[asyncio.TimerHandle] = set()
+
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def start(self):
+        # the queue is created here, inside the running loop, rather than in __init__
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 30.0):
+        if self._queue is None:
+            return
+
+        # stop scheduling retries, then give the workers a chance to flush what's already queued
+        for handle in self._retries:
+            handle.cancel()
+            self.dropped += 1
+        self._retries.clear()
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.dropped += self._queue.qsize()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def enqueue(self, message: EmailMessage) -> bool:
+        # never blocks. returns False if the message couldn't be queued (queue full, or the queue isn't running)
+        if self._queue is None:
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    def _retry(self, message: EmailMessage):
+        message.attempts += 1
+        if message.attempts >= self.max_attempts:
+            self.dropped += 1
+            log.warning('giving up on email', to=message.to, attempts=message.attempts)
+            return
+
+        self.retried += 1
+        delay = min(self.backoff * 2 ** (message.attempts - 1), self.max_backoff)
+        handle = None
+
+        def requeue():
+            self._retries.discard(handle)
+            self.enqueue(message)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                failed = await asyncio.to_thread(self.transport.send_batch, batch)
+            except Exception:
+                failed = batch
+
+            self.sent += len(batch) - len(failed)
+            for message in failed:
+                self._retry(message)
+            for _ in batch:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "retrying": len(self._retries),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
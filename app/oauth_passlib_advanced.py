@@ -17,59 +17,60 @@ JWT FTW !!!
 """
 
 import os
-from fastapi import FastAPI, Depends, HTTPException, Request, Response, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from datetime import datetime, timedelta
-from pydantic import BaseModel, Field
-
-from typing import Annotated, Callable
-
-# jwt is imported from jose. make sure python-jose[cryptography] is installed in pip
-from jose import jwt, JWTError, ExpiredSignatureError
-from .simple_oauth_passlib import Journal
+from fastapi.security import OAuth2PasswordRequestForm
+
+from typing import Annotated
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+
+from .simple_oauth_passlib import Journal, pwd_hasher, journal_etag
+from .journal_store import UsernameTaken
+from .hashing import PasswordHasher, HasherBusy, hasher_busy_handler
+from .bearer_tokens import BearerTokens
+from .notifications import EmailQueue, EmailMessage, SMTPTransport
+from .static_cache import StaticAsset
+from .metrics import install_metrics, registry
+from .compression import install_compression
+from .rate_limit import login_throttle, RateLimited, rate_limited_handler
+from .log import get_logger
+from .keyring import KeyringError, keyring_error_handler
 from passlib.context import CryptContext
 
 
 # load secret key and algo from environment. do this for security - don't store keys in code.
 # Run this command in cmd to set env vars
 #   export <key_name>=<key_here>
-API_KEY = os.environ['X_API_KEY']
-API_KEY_ALGO = os.environ['X_API_KEY_ALGO']
-API_KEY_TTL = 300
+# a verification-only replica doesn't have these at all. it verifies with the public keys from X_KEYRING. see keyring.py
+API_KEY = os.environ.get('X_API_KEY')
+API_KEY_ALGO = os.environ.get('X_API_KEY_ALGO')
 
 passlib_crypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-oauth2 = OAuth2PasswordBearer(tokenUrl='access-token')
-
-
-def get_token_expiry(ttl: int = API_KEY_TTL) -> datetime:
-    # use utc time to get current universal time, and then set the expiry date of a token by adding the timedelta.
-    # in this case it is 300 seconds (5 minutes)
-    return datetime.utcnow() + timedelta(seconds=ttl)
+password_hasher = PasswordHasher(passlib_crypt_context)
+log = get_logger(__name__)
+# access and refresh tokens, and the routes that take them (/refresh, /journal, /logout...). see bearer_tokens.py
+bearer_tokens = BearerTokens(Journal, token_url='access-token', journal_etag=journal_etag)
 
+# outbound emails are queued and sent by background workers. see notifications.py
+email_queue = EmailQueue(SMTPTransport.from_env(), workers=int(os.environ.get('X_EMAIL_WORKERS', 2)))
 
-class AccessToken(BaseModel):
-    """
-    Helper class for generating access token.
-    'sub' and 'exp' are fields to be used in the JWT.
-        sub - refers to something like a username. The important thing to have in mind is that the sub key should have a
-            unique identifier across the entire application, and it should be a string.
-        exp - refers to the expiry time of the token
-    """
 
-    sub: str
-    exp: datetime = Field(default_factory=get_token_expiry)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # picks the bcrypt cost for this host, if X_BCRYPT_BUDGET_MS is set. Journal.add_to_db hashes with the simple app's
+    # hasher, so that one gets calibrated as well
+    await password_hasher.calibrate()
+    await pwd_hasher.calibrate()
+    await email_queue.start()
+    yield
+    await email_queue.stop()
 
-    def generate(self):
-        # first arg to jwt.encode is the payload dict, next is the api key, and next is the algorithm
-        token = jwt.encode(self.model_dump(), API_KEY, API_KEY_ALGO)
-        return {    # remember to use the keys exactly as defined by oauth standards
-            "access_token": token,
-            "token_type": "bearer"
-        }
 
-
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(HasherBusy, hasher_busy_handler)
+app.add_exception_handler(RateLimited, rate_limited_handler)
+app.add_exception_handler(KeyringError, keyring_error_handler)
 
 allowed_origins = [
     'http://localhost:8000'
@@ -84,22 +85,23 @@ app.add_middleware(
 )
 
 
-@app.middleware('http')
-async def http_middleware(request: Request, call_next: Callable):
-    from time import time
-
-    now = lambda: round(time() * 1000)
-    curr_time = now()
-
-    response: Response = await call_next(request)
-    response.headers['X-Proc-Time'] = f"{now() - curr_time} milliseconds"
-    return response
+install_compression(app, 'oauth_passlib_advanced')
+# latency histograms, status counts etc. at /metrics, plus the X-Proc-Time header. see metrics.py
+install_metrics(app, 'oauth_passlib_advanced')
+registry.register_stats('jwt_cache', bearer_tokens.decoded_token_cache.stats, {'app': 'oauth_passlib_advanced'})
+registry.register_stats('email_queue', email_queue.stats)
+registry.register_stats('password_hasher', password_hasher.stats, {'app': 'oauth_passlib_advanced'})
+registry.register_stats('refresh_tokens', bearer_tokens.refresh_tokens.stats, {'app': 'oauth_passlib_advanced'})
+app.include_router(bearer_tokens.router)
 
 
 async def send_email(username: str, email: str):
-    import time
-    time.sleep(7)
-    print(f"Email to {username} <{email}>: thanks for your journal. Add more entries soon xoxo")
+    # only puts the email on the queue. the actual sending happens in the email queue's workers
+    email_queue.enqueue(EmailMessage(
+        to=f"{username} <{email}>",
+        subject="Thanks for your journal",
+        body="thanks for your journal. Add more entries soon xoxo"
+    ))
 
 
 @app.get('/secrets')
@@ -112,61 +114,52 @@ def get_secrets():
 
 @app.post('/journal', response_model_include={'username'})
 async def insert_journal(journal: Journal, tasks: BackgroundTasks) -> Journal:
-    Journal.add_to_db(journal)
+    try:
+        await Journal.add_to_db(journal)
+    except UsernameTaken:
+        raise HTTPException(status_code=409, detail='Journal already exists')
     if journal.email is not None:
         tasks.add_task(send_email, journal.username, journal.email)
     return journal
 
 
 @app.post('/access-token')
-async def get_access_token(credentials: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def get_access_token(request: Request, credentials: Annotated[OAuth2PasswordRequestForm, Depends()]):
     username = credentials.username
     password = credentials.password
 
-    journal = Journal.get(username)
+    # too many attempts from this client, or for this username, get a 429 before we spend any time hashing.
+    # see rate_limit.py
+    await login_throttle.check(request, username, scope='oauth_passlib_advanced')
 
+    # the store calls are SQLite queries (and the update a write transaction), so they run in the threadpool
+    journal = await run_in_threadpool(Journal.get, username)
     if not journal:
         raise HTTPException(status_code=404, detail='Journal not found')
-    if not password or not passlib_crypt_context.verify(password, journal.password):
+    if not password:
+        raise HTTPException(status_code=402, detail='Invalid credentials')
+
+    verified, new_hash = await password_hasher.verify_and_update(password, journal.password)
+    if not verified:
         raise HTTPException(status_code=402, detail='Invalid credentials')
+    if new_hash is not None:
+        await run_in_threadpool(Journal.update, username, password=new_hash)
+        log.info('rehashed password', username=username)
 
     # in simple_oauth_passlib.py, we were generating the access token ourselves by hashing the username and password.
     # in this case, we're generating the access token using JWT. only the username is the personally identifying
     # information stored in the JWT.
-    access_token = AccessToken(sub=username)
-    return access_token.generate()
+    # the refresh token that comes with it is what the client uses to get the next access token. see /refresh
+    return bearer_tokens.issue(username)
 
 
-@app.get('/login-page')
-def get_login_page():
-    with open('page.html', 'r') as page:
-        return Response(page.read(), media_type='text/html')
-
+# read once and kept in memory. reloaded only if the file changes on disk. see static_cache.py
+login_page = StaticAsset(os.path.join(os.path.dirname(__file__), 'page.html'), media_type='text/html')
 
-@app.get('/journal', response_model_exclude={'password'})
-async def get_journal(token: Annotated[str, Depends(oauth2)]) -> Journal:
-    CredentialsError = HTTPException(status_code=401, detail='Invalid authorization', headers={'WWW-Authenticate': 'Bearer'})
 
+@app.get('/login-page')
+def get_login_page(request: Request):
     try:
-        # decoding the token is fairly the same process as encoding it.
-        # a little change (at least what i noticed from the tutorials) is that algorithms is passed as a list (even if
-        # it's only one algorithm), but still params are as follows: token, key, algo
-        token = jwt.decode(token, API_KEY, algorithms=[API_KEY_ALGO])
-        username = token.get('sub')     # this info is contained within the claims of the JWT.
-
-        if username is None:
-            raise CredentialsError
-
-        journal = Journal.get(username)
-
-        if journal is None:
-            raise CredentialsError
-
-        return journal
-    except ExpiredSignatureError:
-        # error thrown when the JWT expires. in that case, the client will have to request a new token.
-        # you can return information in the http exception that will hint the client code that it will have to request
-        # a new token.
-        raise HTTPException(status_code=401, detail="Expired token")
-    except JWTError:
-        raise CredentialsError
+        return login_page.response(request)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail='Login page not found')
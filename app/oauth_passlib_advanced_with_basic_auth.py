@@ -23,31 +23,34 @@ This is a typical request:
 Running the code below might not work in OpenAPI docs, but it works in real life :)
 """
 
-import os
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.security import OAuth2PasswordBearer
+from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from datetime import datetime, timedelta
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, EmailStr
 from fastapi.middleware.cors import CORSMiddleware
 
-from typing import Annotated, Callable, Union
+from typing import Annotated, Union
+from contextlib import asynccontextmanager
 
-# jwt is imported from jose. make sure python-jose[cryptography] is installed in pip
-from jose import jwt, JWTError, ExpiredSignatureError
 from passlib.context import CryptContext
-import secrets
+from starlette.concurrency import run_in_threadpool
 
+from .journal_store import UsernameTaken
+from .storage import CachedJournals
+from .hashing import PasswordHasher, HasherBusy, hasher_busy_handler
+from .bearer_tokens import BearerTokens
+from .metrics import install_metrics, registry
+from .compression import install_compression
+from .rate_limit import login_throttle, RateLimited, rate_limited_handler
+from .log import get_logger
+from .etags import version_etag
+from .keyring import KeyringError, keyring_error_handler
+from .basic_credentials import BasicAuthVerifier, password_admin_router
+
+log = get_logger(__name__)
 
-# load secret key and algo from environment. do this for security - don't store keys in code.
-# Run this command in cmd to set env vars
-#   export <key_name>=<key_here>
-API_KEY = os.environ['X_API_KEY']
-API_KEY_ALGO = os.environ['X_API_KEY_ALGO']
-API_KEY_TTL = 300
 
 passlib_crypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-oauth2 = OAuth2PasswordBearer(tokenUrl='login')
+password_hasher = PasswordHasher(passlib_crypt_context)
 http_basic_security = HTTPBasic()
 
 
@@ -56,28 +59,41 @@ class Journal(BaseModel):
     password: str  # hashed password. don't store raw passwords
     secrets: str
     email: EmailStr | None = None
-    __journals__: list['Journal'] = []
+    __journals__: CachedJournals    # backed by the 'basic_auth_journals' table. set up right below the class
 
     @classmethod
-    def add_to_db(cls, journal: 'Journal'):
-        # adds journal to database
-        journal.password = passlib_crypt_context.hash(journal.password)
-        print("Added new journal to db:", journal)
-        cls.__journals__.append(journal)
+    async def add_to_db(cls, journal: 'Journal'):
+        # adds journal to database. raises UsernameTaken if the username is taken
+        if journal.username in cls.__journals__:
+            raise UsernameTaken(journal.username)
+        journal.password = await password_hasher.hash(journal.password)
+        log.info('added new journal to db', journal=journal)     # password and secrets are redacted
+        cls.__journals__.add(journal)
 
     @classmethod
     def all(cls):
-        return cls.__journals__
+        return list(cls.__journals__)
 
     @classmethod
     def get(cls, username: str) -> Union['Journal', None]:
-        for journal in cls.__journals__:
-            # if journal.username == username: # don't use this simple equality approach to compare username
-            # using secrets.compare_digest from python's standard 'secret' module is more secure against attacks like
-            # timing attacks and a whole range of security attacks.
-            if secrets.compare_digest(username.encode('utf8'), journal.username.encode('utf8')):
-                return journal
-        return None
+        # if journal.username == username: # don't use this simple equality approach to compare username
+        # the store looks journals up by a keyed hash of the username, and then compares the username itself using
+        # secrets.compare_digest from python's standard 'secret' module, which is more secure against attacks like
+        # timing attacks and a whole range of security attacks.
+        return cls.__journals__.get(username)
+
+    @classmethod
+    def get_versioned(cls, username: str) -> tuple[int, Union['Journal', None]]:
+        # the journal, plus the version of the journals table it was read at. for the ETag. see etags.py
+        return cls.__journals__.get_versioned(username)
+
+    @classmethod
+    def update(cls, username: str, /, **changes) -> Union['Journal', None]:
+        return cls.__journals__.update(username, **changes)
+
+    @classmethod
+    def delete(cls, username: str) -> bool:
+        return cls.__journals__.delete(username)
 
     def get_hash_salt(self):
         # this method returns content that will be used to generate the access token.
@@ -85,34 +101,49 @@ class Journal(BaseModel):
         return self.username + "." + self.password
 
 
-def get_token_expiry(ttl: int = API_KEY_TTL) -> datetime:
-    # use utc time to get current universal time, and then set the expiry date of a token by adding the timedelta.
-    # in this case it is 300 seconds (5 minutes)
-    return datetime.utcnow() + timedelta(seconds=ttl)
+Journal.__journals__ = CachedJournals('basic_auth_journals', Journal)
+
+
+def journal_etag(version: int, username: str) -> str:
+    # the username is in the token, not the URL, so it's part of the ETag (as a keyed digest). see etags.py
+    return version_etag(Journal.__journals__.db, 'j', version, username)
 
 
-class AccessToken(BaseModel):
-    """
-    Helper class for generating access token.
-    'sub' and 'exp' are fields to be used in the JWT.
-        sub - refers to something like a username. The important thing to have in mind is that the sub key should have a
-            unique identifier across the entire application, and it should be a string.
-        exp - refers to the expiry time of the token
-    """
+def set_password(username: str, new_hash: str) -> Journal | None:
+    return Journal.update(username, password=new_hash)
 
-    sub: str
-    exp: datetime = Field(default_factory=get_token_expiry)
 
-    def generate(self):
-        # first arg to jwt.encode is the payload dict, next is the api key, and next is the algorithm
-        token = jwt.encode(self.model_dump(), API_KEY, API_KEY_ALGO)
-        return {    # remember to use the keys exactly as defined by oauth standards
-            "access_token": token,
-            "token_type": "bearer"
-        }
+def rehash_password(username: str, new_hash: str) -> Journal | None:
+    log.info('rehashed password', username=username)
+    return set_password(username, new_hash)
 
 
-app = FastAPI()
+# the client sends the password with every /login. bcrypt only runs the first time, and again once the cached
+# verification expires (or the password changes). see basic_credentials.py
+basic_auth_verifier = BasicAuthVerifier(password_hasher, Journal.get, rehash_password)
+# access and refresh tokens, and the routes that take them (/refresh, /journal, /logout...). see bearer_tokens.py
+bearer_tokens = BearerTokens(Journal, token_url='login', journal_etag=journal_etag)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # picks the bcrypt cost for this host, if X_BCRYPT_BUDGET_MS is set. see hashing.py
+    await password_hasher.calibrate()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(HasherBusy, hasher_busy_handler)
+app.add_exception_handler(RateLimited, rate_limited_handler)
+app.add_exception_handler(KeyringError, keyring_error_handler)
+install_compression(app, 'oauth_passlib_advanced_with_basic_auth')
+install_metrics(app, 'oauth_passlib_advanced_with_basic_auth')
+registry.register_stats('jwt_cache', bearer_tokens.decoded_token_cache.stats, {'app': 'oauth_passlib_advanced_with_basic_auth'})
+registry.register_stats('password_hasher', password_hasher.stats, {'app': 'oauth_passlib_advanced_with_basic_auth'})
+registry.register_stats('refresh_tokens', bearer_tokens.refresh_tokens.stats, {'app': 'oauth_passlib_advanced_with_basic_auth'})
+registry.register_stats('basic_auth_cache', basic_auth_verifier.stats, {'app': 'oauth_passlib_advanced_with_basic_auth'})
+app.include_router(bearer_tokens.router)
+app.include_router(password_admin_router(basic_auth_verifier, set_password))
 # allowed_hosts = [
 #     'http://10.203.187.53:8000'
 # ]
@@ -121,56 +152,34 @@ app = FastAPI()
 
 @app.post('/journal', response_model_include={'username'})
 async def insert_journal(journal: Journal) -> Journal:
-    Journal.add_to_db(journal)
+    try:
+        await Journal.add_to_db(journal)
+    except UsernameTaken:
+        raise HTTPException(status_code=409, detail='Journal already exists')
     return journal
 
 
 @app.get('/login')
-async def get_access_token(credentials: Annotated[HTTPBasicCredentials, Depends(http_basic_security)]):
+async def get_access_token(request: Request, credentials: Annotated[HTTPBasicCredentials, Depends(http_basic_security)]):
     username = credentials.username
     password = credentials.password
 
-    print("username:", username)
-    print("password:", password)
+    log.info('login attempt', username=username)
 
-    journal = Journal.get(username)
+    # credentials verified a moment ago get their token straight away. they cost no hashing, so they don't count
+    # against the login throttle either - a Basic auth client sends them with every request
+    if await run_in_threadpool(basic_auth_verifier.cached, username, password) is None:
+        # anything else is throttled before any hashing happens. see rate_limit.py
+        await login_throttle.check(request, username, scope='oauth_passlib_advanced_with_basic_auth')
 
-    if not journal:
-        raise HTTPException(status_code=404, detail='Journal not found')
-    if password is None or not passlib_crypt_context.verify(password, journal.password):
-        raise HTTPException(status_code=402, detail='Invalid credentials')
+        journal = await run_in_threadpool(Journal.get, username)
+        if not journal:
+            raise HTTPException(status_code=404, detail='Journal not found')
+        if await basic_auth_verifier.verify(username, password) is None:
+            raise HTTPException(status_code=402, detail='Invalid credentials')
 
     # in simple_oauth_passlib.py, we were generating the access token ourselves by hashing the username and password.
     # in this case, we're generating the access token using JWT. only the username is the personally identifying
     # information stored in the JWT.
-    access_token = AccessToken(sub=username)
-    return access_token.generate()
-
-
-@app.get('/journal', response_model_exclude={'password'})
-async def get_journal(token: Annotated[str, Depends(oauth2)]) -> Journal:
-    CredentialsError = HTTPException(status_code=401, detail='Invalid authorization', headers={'WWW-Authenticate': 'Bearer'})
-
-    try:
-        # decoding the token is fairly the same process as encoding it.
-        # a little change (at least what i noticed from the tutorials) is that algorithms is passed as a list (even if
-        # it's only one algorithm), but still params are as follows: token, key, algo
-        token = jwt.decode(token, API_KEY, algorithms=[API_KEY_ALGO])
-        username = token.get('sub')     # this info is contained within the claims of the JWT.
-
-        if username is None:
-            raise CredentialsError
-
-        journal = Journal.get(username)
-
-        if journal is None:
-            raise CredentialsError
-
-        return journal
-    except ExpiredSignatureError:
-        # error thrown when the JWT expires. in that case, the client will have to request a new token.
-        # you can return information in the http exception that will hint the client code that it will have to request
-        # a new token.
-        raise HTTPException(status_code=401, detail="Expired token")
-    except JWTError:
-        raise CredentialsError
+    # the refresh token that comes with it is what the client uses to get the next access token. see /refresh
+    return bearer_tokens.issue(username)
@@ -0,0 +1,73 @@
+"""
+Helpers for reading long lists a piece at a time.
+
+Cursor pagination:
+    the client asks for `limit` items and gets back the items plus a `next_cursor`. to get the next page it sends that
+    cursor back. cursors are opaque to the client (base64-encoded), so the way we represent a position can change
+    without breaking anyone.
+    paginate_after uses the key (e.g. the id) of the last item on the page as the position, instead of its index. pages
+    don't shift when items are added or removed in front of the cursor, and finding the page is a binary search.
+
+NDJSON streaming:
+    newline-delimited JSON - one JSON document per line. the response is produced by a generator which serializes a few
+    items at a time, so the full JSON body never has to exist in memory at once, and the client starts receiving data
+    right away.
+"""
+
+import base64
+import binascii
+from bisect import bisect_right
+from typing import Any, Generic, Iterable, Iterator, TypeVar
+
+from pydantic import BaseModel, TypeAdapter
+
+T = TypeVar('T')
+
+
+class InvalidCursor(Exception):
+
+    def __init__(self, cursor: str):
+        self.cursor = cursor
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None = None
+
+
+def encode_cursor(position: int) -> str:
+    return base64.urlsafe_b64encode(str(position).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor: str | None) -> int:
+    if cursor is None:
+        return 0
+    try:
+        position = int(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, ValueError, UnicodeEncodeError):
+        raise InvalidCursor(cursor)
+    if position < 0:
+        raise InvalidCursor(cursor)
+    return position
+
+
+def paginate_after(keys: tuple[int, ...], items: tuple, cursor: str | None, limit: int) -> tuple[tuple, str | None]:
+    # keys must be sorted, and items in the same order. returns the items after the key in the cursor, and the cursor
+    # of the next page (None if this is the last page)
+    start = bisect_right(keys, decode_cursor(cursor)) if cursor is not None else 0
+    page = items[start:start + limit]
+    end = start + len(page)
+    return page, encode_cursor(keys[end - 1]) if end < len(items) else None
+
+
+def ndjson_lines(items: Iterable[Any], adapter: TypeAdapter, batch_size: int = 100) -> Iterator[bytes]:
+    # yields the items as NDJSON, batch_size items per chunk. one chunk per item would mean one trip through the
+    # response machinery (and a threadpool hop, for sync generators) per item, which adds up fast
+    batch = []
+    for item in items:
+        batch.append(adapter.dump_json(item))
+        if len(batch) >= batch_size:
+            yield b'\n'.join(batch) + b'\n'
+            batch = []
+    if batch:
+        yield b'\n'.join(batch) + b'\n'
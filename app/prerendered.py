@@ -0,0 +1,104 @@
+"""
+Pre-rendered HTML pages.
+
+The error pages (and /xml) used to be put together from f-strings on every response, even though all of it, except
+for maybe a detail message, never changes. A PrerenderedPage does that work once, when it's created:
+    - the template is split into its static parts and the {fields} that change per response. the static parts are
+      encoded to bytes up front
+    - pages without fields are compressed up front, with every encoding we support, and get a fixed ETag
+    - pages with fields keep a gzip compressor primed with everything up to the first field. each response copies that
+      compressor and only compresses the rest, instead of compressing the whole page from scratch
+    - If-None-Match is answered with a 304, without a body
+
+Dynamic field values are HTML-escaped before they're spliced in.
+"""
+
+import hashlib
+import html
+import re
+
+from fastapi import Request, Response
+
+from .encoding import AVAILABLE_ENCODINGS, compress, gzip_compressobj, negotiate
+from .etags import etag_matches
+
+
+class PrerenderedPage:
+
+    def __init__(
+            self,
+            template: str,
+            fields: tuple[str, ...] = (),
+            status_code: int = 200,
+            media_type: str = 'text/html',
+            headers: dict[str, str] | None = None
+    ):
+        self.status_code = status_code
+        self.media_type = media_type
+        self.headers = headers or {}
+        self.fields = fields
+
+        if fields:
+            # 'a {detail} b' -> ['a ', 'detail', ' b']: static parts at even indexes, field names at odd ones
+            pattern = '{(' + '|'.join(re.escape(field) for field in fields) + ')}'
+            parts = re.split(pattern, template)
+        else:
+            parts = [template]
+        self._parts = [part.encode('utf8') if i % 2 == 0 else part for i, part in enumerate(parts)]
+
+        # the template's own fingerprint. dynamic pages mix the field values into it to get their ETags
+        self._fingerprint = hashlib.blake2b(template.encode('utf8'), digest_size=8).hexdigest()
+
+        if fields:
+            self._gzip_prefix = gzip_compressobj()
+            # whatever the compressor has already let out (at least the gzip header) comes first in every response
+            self._gzip_head = self._gzip_prefix.compress(self._parts[0])
+        else:
+            self.body = self._parts[0]
+            self.etag = f'"{self._fingerprint}"'
+            self.variants = {encoding: compress(self.body, encoding) for encoding in AVAILABLE_ENCODINGS}
+
+    def _etag(self, values: dict[str, str]) -> str:
+        if not self.fields:
+            return self.etag
+        digest = hashlib.blake2b(self._fingerprint.encode('ascii'), digest_size=8)
+        for field in self.fields:
+            digest.update(b'\0' + values.get(field, '').encode('utf8'))
+        return f'"{digest.hexdigest()}"'
+
+    def _render(self, values: dict[str, str], encoding: str | None) -> bytes:
+        if not self.fields:
+            return self.variants[encoding] if encoding else self.body
+
+        rest = b''.join(
+            part if i % 2 == 0 else html.escape(values.get(part, '')).encode('utf8')
+            for i, part in enumerate(self._parts) if i > 0
+        )
+        if encoding == 'gzip':
+            compressor = self._gzip_prefix.copy()
+            return self._gzip_head + compressor.compress(rest) + compressor.flush()
+        return self._parts[0] + rest
+
+    def response(self, request: Request, **values: str) -> Response:
+        etag = self._etag(values)
+        headers = {**self.headers, 'ETag': etag, 'Vary': 'Accept-Encoding'}
+
+        # only a successful GET (or HEAD) can be answered with a 304. an error page or the reply to a POST isn't
+        # "the same as what you have"
+        cacheable = request.method in ('GET', 'HEAD') and self.status_code == 200
+        if cacheable and etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        # dynamic pages only keep a gzip compressor ready, so that's all they can offer
+        available = AVAILABLE_ENCODINGS if not self.fields else ('gzip',)
+        encoding = negotiate(request.headers.get('accept-encoding'), available)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        # Response sets Content-Length from the body
+        return Response(
+            self._render(values, encoding),
+            status_code=self.status_code,
+            media_type=self.media_type,
+            headers=headers
+        )
@@ -0,0 +1,256 @@
+"""
+Login throttling.
+
+Every login attempt costs a bcrypt verify (~200ms of CPU), whether the password is right or not. Without a limit, one
+client trying leaked username/password pairs (credential stuffing) can keep every core busy hashing.
+
+LoginThrottle keeps two token buckets per attempt: one for the client's IP and one for the username being tried. A
+bucket holds up to `capacity` tokens and refills at `capacity / per_seconds` tokens per second. Each attempt takes one
+token from both buckets, *before* any hashing happens. If either bucket is empty, the attempt is rejected with
+RateLimited, which rate_limited_handler turns into a 429 with a Retry-After header.
+    - the per-IP bucket stops one client from trying lots of usernames
+    - the per-username bucket stops lots of clients (a botnet) from hammering one account
+
+Memory stays bounded: a bucket that has been idle long enough to refill completely is the same as no bucket at all, so
+idle buckets are dropped. On top of that, at most X_RATE_LIMIT_MAX_KEYS buckets are kept (the least recently used go
+first).
+
+The buckets live in memory by default, so each worker process counts on its own. For several workers (or several
+machines sharing a disk), point X_RATE_LIMIT_BACKEND at a SQLite file and they'll all share the same buckets.
+
+Config (environment variables):
+    X_LOGIN_RATE_IP         '<attempts>/<seconds>' per client IP. defaults to '20/60'. '0' turns the limit off
+    X_LOGIN_RATE_USER       '<attempts>/<seconds>' per username. defaults to '10/60'. '0' turns the limit off
+    X_RATE_LIMIT_BACKEND    'memory' (default), or the path of a SQLite file to share buckets between processes
+    X_RATE_LIMIT_MAX_KEYS   max number of buckets kept in memory. defaults to 100000
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import anyio
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from .metrics import registry
+from .storage import Database
+
+LOGIN_RATE_IP = os.environ.get('X_LOGIN_RATE_IP', '20/60')
+LOGIN_RATE_USER = os.environ.get('X_LOGIN_RATE_USER', '10/60')
+RATE_LIMIT_BACKEND = os.environ.get('X_RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('X_RATE_LIMIT_MAX_KEYS', 100_000))
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class Limit:
+    capacity: int           # attempts allowed in a burst
+    per_seconds: float      # time it takes an empty bucket to refill completely
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.per_seconds
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Limit | None':
+        # '20/60' -> 20 attempts per 60 seconds. '0' or '' -> no limit
+        if not spec or spec.strip() == '0':
+            return None
+        attempts, _, seconds = spec.partition('/')
+        return cls(int(attempts), float(seconds or 1))
+
+
+def _refill(tokens: float, updated: float, limit: Limit, now: float) -> float:
+    return min(limit.capacity, tokens + (now - updated) * limit.rate)
+
+
+class MemoryBuckets:
+    """
+    Token buckets in a dict, in least-recently-used order. Thread-safe, since sync endpoints run in a threadpool.
+    """
+
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> (tokens, last updated, time at which it will be full again)
+        self._buckets: OrderedDict[str, tuple[float, float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def take(self, key: str, limit: Limit, now: float) -> float:
+        """
+        Takes a token from the bucket. Returns 0 if there was one, else the number of seconds until there will be.
+        """
+        with self._lock:
+            self._expire(now)
+
+            entry = self._buckets.pop(key, None)
+            tokens = limit.capacity if entry is None else _refill(entry[0], entry[1], limit, now)
+
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - tokens) / limit.rate
+
+            self._buckets[key] = (tokens, now, now + (limit.capacity - tokens) / limit.rate)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            return retry_after
+
+    def _expire(self, now: float):
+        # the least recently used buckets are at the front. drop them for as long as they've refilled completely
+        # (each call only looks at a handful, so the cost is spread over requests)
+        for _ in range(8):
+            if not self._buckets:
+                return
+            key, (_, _, full_at) = next(iter(self._buckets.items()))
+            if full_at > now:
+                return
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    """
+    Token buckets in a SQLite table, shared by every process that opens the same file. Each take is one short write
+    transaction, so it's slower than the in-memory buckets, but only login attempts pay for it.
+    """
+
+    blocking = True     # sqlite calls block, so they're run in a worker thread
+    TABLE = 'rate_limit_buckets'
+    CREATE_SQL = (
+        f'CREATE TABLE IF NOT EXISTS {TABLE} '
+        f'(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)'
+    )
+    SELECT_SQL = f'SELECT tokens, updated FROM {TABLE} WHERE key = ?'
+    UPSERT_SQL = (
+        f'INSERT INTO {TABLE} (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) '
+        f'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated, full_at = excluded.full_at'
+    )
+    EXPIRE_SQL = f'DELETE FROM {TABLE} WHERE full_at <= ?'
+    COUNT_SQL = f'SELECT COUNT(*) FROM {TABLE}'
+    # how often (in seconds) idle buckets are swept out of the table
+    EXPIRE_EVERY = 60
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._next_expiry = 0.0
+
+    def take(self, key: str, limit: Limit, now: float) -> float:
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.transaction() as conn:
+            if now >= self._next_expiry:
+                conn.execute(self.EXPIRE_SQL, (now,))
+                self._next_expiry = now + self.EXPIRE_EVERY
+
+            row = conn.execute(self.SELECT_SQL, (key,)).fetchone()
+            tokens = limit.capacity if row is None else _refill(row[0], row[1], limit, now)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - tokens) / limit.rate
+            conn.execute(self.UPSERT_SQL, (key, tokens, now, now + (limit.capacity - tokens) / limit.rate))
+        return retry_after
+
+    def __len__(self) -> int:
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.connection() as conn:
+            return conn.execute(self.COUNT_SQL).fetchone()[0]
+
+    def clear(self):
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.transaction() as conn:
+            conn.execute(f'DELETE FROM {self.TABLE}')
+
+
+def buckets_from_config(backend: str = RATE_LIMIT_BACKEND) -> MemoryBuckets | SQLiteBuckets:
+    if backend == 'memory':
+        return MemoryBuckets()
+    return SQLiteBuckets(Database(backend, pool_size=2))
+
+
+class LoginThrottle:
+
+    def __init__(
+            self,
+            per_ip: Limit | None = Limit.parse(LOGIN_RATE_IP),
+            per_username: Limit | None = Limit.parse(LOGIN_RATE_USER),
+            buckets: MemoryBuckets | SQLiteBuckets | None = None
+    ):
+        self.per_ip = per_ip
+        self.per_username = per_username
+        self.buckets = buckets if buckets is not None else buckets_from_config()
+        self.allowed = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _username_key(scope: str, username: str) -> str:
+        # usernames are hashed so that the bucket keys (which may end up in a shared file) don't list who tried what
+        return f'{scope}:user:' + hashlib.sha256(username.encode()).hexdigest()[:32]
+
+    def _take_all(self, ip: str, username: str, scope: str) -> float:
+        now = time.time()
+        retry_after = 0.0
+        if self.per_ip is not None:
+            retry_after = self.buckets.take(f'{scope}:ip:{ip}', self.per_ip, now)
+        if self.per_username is not None and not retry_after:
+            retry_after = self.buckets.take(self._username_key(scope, username), self.per_username, now)
+        return retry_after
+
+    async def check(self, request: Request, username: str, scope: str = 'login'):
+        """
+        Counts a login attempt for the client and the username. Raises RateLimited if either is over its limit.
+        Call this before verifying the password, so that rejected attempts cost no hashing at all.
+        `scope` keeps the buckets of different apps apart when they share a backend.
+        """
+        ip = request.client.host if request.client else 'unknown'
+        if self.buckets.blocking:
+            retry_after = await anyio.to_thread.run_sync(self._take_all, ip, username, scope)
+        else:
+            retry_after = self._take_all(ip, username, scope)
+
+        if retry_after:
+            self.rejected += 1
+            raise RateLimited(retry_after)
+        self.allowed += 1
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "buckets": len(self.buckets),
+            "evicted": getattr(self.buckets, 'evicted', 0),
+        }
+
+
+async def rate_limited_handler(request: Request, e: RateLimited):
+    return JSONResponse(
+        {"detail": "Too many login attempts, try again later"},
+        status_code=429,
+        headers={'Retry-After': str(max(1, math.ceil(e.retry_after)))}
+    )
+
+
+# one throttle shared by every app in the process. apps pass their own scope to check()
+login_throttle = LoginThrottle()
+registry.register_stats('login_throttle', login_throttle.stats)
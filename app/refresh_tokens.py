@@ -0,0 +1,120 @@
+"""
+Rotating refresh tokens.
+
+Access tokens only live for API_KEY_TTL (5 minutes). Without refresh tokens, the only way for a client to get a new one
+is to log in again, and every login is a full bcrypt verify - on purpose the most expensive thing the apps do. For a
+client that stays around all day, that's one bcrypt every five minutes, forever.
+
+So a login now also hands out a refresh token: a long lived (X_REFRESH_TOKEN_TTL, 14 days by default) JWT that can
+only be used at /refresh, to get a new access token. Checking one is a signature check plus a couple of lookups in the
+revocation list (see revocation.py) - no password hashing at all.
+
+Rotation and reuse detection:
+    - every refresh token is good for one use. /refresh uses it up (by putting its jti on the revocation list) and
+      hands out a new one along with the new access token
+    - all the refresh tokens that come from one login form a family (the 'fam' claim), and so do the access tokens
+      handed out with them
+    - if a refresh token that was already used up shows up again, either the client or an attacker has a stolen copy,
+      and we can't tell which one is which. so the whole family is revoked: the family id goes on the revocation list,
+      and every refresh and access token carrying it stops working. the user has to log in again
+
+The revocation list is shared by the workers when X_REVOCATION_BACKEND points at a SQLite file (see serve.py), so a
+refresh token used up on one worker can't be used again on another.
+
+Config (environment variables):
+    X_REFRESH_TOKEN_TTL     lifetime of a refresh token, in seconds. defaults to 14 days
+"""
+
+import os
+import secrets
+import time
+
+from jose import JWTError, ExpiredSignatureError
+
+from .keyring import Keyring
+from .log import get_logger
+from .revocation import revocations as default_revocations, MemoryRevocations, SQLiteRevocations
+
+REFRESH_TOKEN_TTL = int(os.environ.get('X_REFRESH_TOKEN_TTL', 14 * 24 * 3600))
+
+log = get_logger(__name__)
+
+
+class RefreshRejected(Exception):
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RefreshTokens:
+    # the 'typ' claim, so that a refresh token can't be used as an access token, or the other way round
+    TYPE = 'refresh'
+
+    def __init__(
+            self,
+            keyring: Keyring,
+            ttl: int = REFRESH_TOKEN_TTL,
+            revocations: MemoryRevocations | SQLiteRevocations = default_revocations
+    ):
+        self.keyring = keyring
+        self.ttl = ttl
+        self.revocations = revocations
+        self.issued = 0
+        self.rotated = 0
+        self.reused = 0
+
+    def issue(self, sub: str, family: str | None = None) -> tuple[str, str]:
+        """
+        Returns a new refresh token and its family. Without a family, starts a new one (that's a login).
+        """
+        family = family or secrets.token_urlsafe(16)
+        claims = {
+            'sub': sub,
+            'exp': int(time.time()) + self.ttl,
+            'jti': secrets.token_urlsafe(16),
+            'fam': family,
+            'typ': self.TYPE,
+        }
+        self.issued += 1
+        return self.keyring.encode(claims), family
+
+    def rotate(self, token: str) -> tuple[dict, str]:
+        """
+        Uses up the refresh token, and returns its claims and the refresh token that replaces it.
+        Raises RefreshRejected if the token is invalid, expired, revoked, or was already used.
+        """
+        try:
+            claims = self.keyring.decode(token)
+        except ExpiredSignatureError:
+            raise RefreshRejected('expired')
+        except JWTError:
+            raise RefreshRejected('invalid')
+
+        if claims.get('typ') != self.TYPE or not all(claims.get(name) for name in ('sub', 'jti', 'fam')):
+            raise RefreshRejected('invalid')
+        family = claims['fam']
+        if self.revocations.is_revoked(family):
+            raise RefreshRejected('revoked')
+
+        # the jti stays on the list until the token would have expired anyway, and after that jwt.decode rejects it
+        if not self.revocations.revoke_once(claims['jti'], claims['exp']):
+            self.reused += 1
+            self.revoke_family(family)
+            log.warning('refresh token reused. token family revoked', username=claims['sub'])
+            raise RefreshRejected('reused')
+
+        self.rotated += 1
+        new_token, _ = self.issue(claims['sub'], family)
+        return claims, new_token
+
+    def revoke_family(self, family: str):
+        # tokens of the family are handed out with a lifetime of at most ttl from now, so that's how long it has to stay
+        # on the list. rotate won't hand out any new ones once it's there
+        self.revocations.revoke(family, time.time() + self.ttl)
+
+    def is_family_revoked(self, family: str) -> bool:
+        return self.revocations.is_revoked(family)
+
+    def stats(self) -> dict:
+        return {'issued': self.issued, 'rotated': self.rotated, 'reused': self.reused}
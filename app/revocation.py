@@ -0,0 +1,128 @@
+"""
+Token revocation.
+
+A JWT is valid until it expires, wherever it's checked. To log a token out early, we remember its id (the 'jti' claim)
+in a revocation list until the token would have expired anyway - after that, jwt.decode rejects it on its own, so the
+entry can go. The list only ever holds tokens that are revoked *and* still unexpired, so it stays small.
+
+Checking is one dict lookup (or one primary key lookup in SQLite), so it can run on every authenticated request.
+
+With several worker processes, an in-memory list only covers the worker that handled the logout. Point
+X_REVOCATION_BACKEND at a SQLite file (app/serve.py puts one in /dev/shm) and every worker sees every revocation.
+
+Config (environment variables):
+    X_REVOCATION_BACKEND    'memory' (default), or the path of a SQLite file shared between processes
+"""
+
+import os
+import threading
+import time
+
+from .storage import Database
+
+REVOCATION_BACKEND = os.environ.get('X_REVOCATION_BACKEND', 'memory')
+
+
+class MemoryRevocations:
+
+    # how often (in seconds) expired entries are swept out
+    EXPIRE_EVERY = 60
+
+    def __init__(self):
+        self._revoked: dict[str, float] = {}    # token id -> when the token expires
+        self._lock = threading.Lock()
+        self._next_expiry = 0.0
+
+    def revoke(self, token_id: str, expires_at: float):
+        with self._lock:
+            self._revoke(token_id, expires_at)
+
+    def revoke_once(self, token_id: str, expires_at: float) -> bool:
+        # revokes the token unless it already is, and says whether this call did it. of two concurrent calls for the
+        # same token, exactly one gets True. that's how a refresh token is used up (see refresh_tokens.py)
+        with self._lock:
+            if self.is_revoked(token_id):
+                return False
+            self._revoke(token_id, expires_at)
+            return True
+
+    def _revoke(self, token_id: str, expires_at: float):
+        now = time.time()
+        self._revoked[token_id] = expires_at
+        if now >= self._next_expiry:
+            self._revoked = {key: expiry for key, expiry in self._revoked.items() if expiry > now}
+            self._next_expiry = now + self.EXPIRE_EVERY
+
+    def is_revoked(self, token_id: str) -> bool:
+        expires_at = self._revoked.get(token_id)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def clear(self):
+        with self._lock:
+            self._revoked = {}
+
+
+class SQLiteRevocations:
+    """
+    Revoked token ids in a SQLite table, shared by every process that opens the same file. In WAL mode a lookup never
+    waits for a writer, so is_revoked is cheap enough to call from the event loop.
+    """
+
+    TABLE = 'revoked_tokens'
+    CREATE_SQL = f'CREATE TABLE IF NOT EXISTS {TABLE} (token_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)'
+    REVOKE_SQL = f'INSERT OR REPLACE INTO {TABLE} (token_id, expires_at) VALUES (?, ?)'
+    REVOKE_ONCE_SQL = f'INSERT OR IGNORE INTO {TABLE} (token_id, expires_at) VALUES (?, ?)'
+    DELETE_EXPIRED_SQL = f'DELETE FROM {TABLE} WHERE token_id = ? AND expires_at <= ?'
+    SELECT_SQL = f'SELECT 1 FROM {TABLE} WHERE token_id = ? AND expires_at > ?'
+    EXPIRE_SQL = f'DELETE FROM {TABLE} WHERE expires_at <= ?'
+    COUNT_SQL = f'SELECT COUNT(*) FROM {TABLE}'
+    EXPIRE_EVERY = 60
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._next_expiry = 0.0
+
+    def revoke(self, token_id: str, expires_at: float):
+        now = time.time()
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.transaction() as conn:
+            conn.execute(self.REVOKE_SQL, (token_id, expires_at))
+            if now >= self._next_expiry:
+                conn.execute(self.EXPIRE_SQL, (now,))
+                self._next_expiry = now + self.EXPIRE_EVERY
+
+    def revoke_once(self, token_id: str, expires_at: float) -> bool:
+        # BEGIN IMMEDIATE serializes this across processes, so only one of them gets to insert the row
+        now = time.time()
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.transaction() as conn:
+            conn.execute(self.DELETE_EXPIRED_SQL, (token_id, now))     # a stale entry doesn't count
+            return conn.execute(self.REVOKE_ONCE_SQL, (token_id, expires_at)).rowcount == 1
+
+    def is_revoked(self, token_id: str) -> bool:
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.connection() as conn:
+            return conn.execute(self.SELECT_SQL, (token_id, time.time())).fetchone() is not None
+
+    def __len__(self) -> int:
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.connection() as conn:
+            return conn.execute(self.COUNT_SQL).fetchone()[0]
+
+    def clear(self):
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.transaction() as conn:
+            conn.execute(f'DELETE FROM {self.TABLE}')
+
+
+def revocations_from_config(backend: str = REVOCATION_BACKEND) -> MemoryRevocations | SQLiteRevocations:
+    if backend == 'memory':
+        return MemoryRevocations()
+    return SQLiteRevocations(Database(backend, pool_size=4))
+
+
+# one list shared by every app in the process
+revocations = revocations_from_config()
@@ -0,0 +1,262 @@
+"""
+Production entry point: one master process, N forked uvicorn workers sharing one listening socket.
+
+    python -m app.serve app.oauth_passlib_advanced:app --host 0.0.0.0 --port 80
+
+A single uvicorn process uses one core for everything (bcrypt, JWTs, JSON), however many the machine has. Here:
+    - the master binds the socket, imports the app once (preload), and forks the workers. forked workers share the
+      master's memory pages for everything imported so far, and start fast. with --no-preload, each worker imports the
+      app itself after the fork instead (slower, but a rolling restart then picks up new code)
+    - each worker runs uvicorn on the inherited socket, with uvloop and httptools when they're installed. the kernel
+      spreads incoming connections over the workers
+    - a worker that dies is replaced
+    - SIGHUP: rolling restart. workers are replaced one at a time, and an old worker is only told to stop (gracefully:
+      it finishes its in-flight requests) once its replacement is accepting connections. no downtime
+    - SIGTERM / SIGINT: every worker is stopped gracefully, and killed if it takes longer than --graceful-timeout
+
+Each worker is its own process, so in-memory state isn't shared. The state that has to be the same for every worker
+(login rate limit buckets, revoked tokens) is kept in a SQLite file in /dev/shm - shared memory, so no disk I/O - by
+pointing X_RATE_LIMIT_BACKEND and X_REVOCATION_BACKEND at it, unless they're set already. Likewise, without an
+X_TOKEN_SECRET, each worker would sign simple_oauth_passlib's tokens with its own random key and reject the others'
+tokens, so the master makes one up before forking (it's gone when the master stops, so set it yourself for tokens that
+outlive a restart). Caches (decoded tokens, journals, recruits) stay per worker: they're either safe to be a little
+stale, or already check the db's version numbers (see storage.py). /metrics reports on whichever worker answers the
+scrape.
+
+Config (environment variables, overridden by the command line options):
+    X_HOST              defaults to 127.0.0.1
+    X_PORT              defaults to 8000
+    X_WORKERS           defaults to the number of CPUs
+    X_SHARED_STATE_PATH SQLite file for the shared state. defaults to /dev/shm/2fast2furious-<port>.db
+"""
+
+import argparse
+import importlib.util
+import os
+import secrets
+import select
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+
+def _default_shared_state_path(port: int) -> str:
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'2fast2furious-{port}.db')
+
+
+def _import_uvicorn():
+    # imported after the environment is set up, since importing anything from app/ reads it
+    import uvicorn
+    from uvicorn.server import Server
+
+    class WorkerServer(Server):
+        # tells the master when the worker is ready to accept connections, by writing a byte down a pipe
+
+        def __init__(self, config: uvicorn.Config, ready_fd: int):
+            super().__init__(config)
+            self.ready_fd = ready_fd
+
+        async def startup(self, sockets=None):
+            await super().startup(sockets)
+            if self.started:
+                os.write(self.ready_fd, b'1')
+            os.close(self.ready_fd)
+
+        def install_signal_handlers(self):
+            # SIGHUP is for the master. workers ignore it rather than die
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            super().install_signal_handlers()
+
+    return uvicorn, WorkerServer
+
+
+class Master:
+
+    def __init__(self, args):
+        self.args = args
+        self.workers: dict[int, float] = {}     # pid -> when it was started
+        self.app = None
+        self.socket: socket.socket | None = None
+        self.stopping = False
+        self.reload_requested = False
+
+    def _log(self, message: str):
+        print(f'[serve {os.getpid()}] {message}', file=sys.stderr, flush=True)
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ':' in self.args.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.args.host, self.args.port))
+        sock.listen(self.args.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def _uvicorn_config(self, uvicorn):
+        loop = 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio'
+        http = 'httptools' if importlib.util.find_spec('httptools') else 'h11'
+        return uvicorn.Config(
+            self.app if self.app is not None else self.args.app,
+            loop=loop,
+            http=http,
+            lifespan='on',
+            access_log=self.args.access_log,
+            proxy_headers=self.args.proxy_headers,
+            timeout_graceful_shutdown=self.args.graceful_timeout,
+        )
+
+    def spawn(self) -> tuple[int, int]:
+        # forks a worker. returns its pid, and the pipe it reports readiness on
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            code = 0
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+                    signal.signal(sig, signal.SIG_DFL)
+                uvicorn, WorkerServer = _import_uvicorn()
+                server = WorkerServer(self._uvicorn_config(uvicorn), ready_write)
+                server.run(sockets=[self.socket])
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+
+        os.close(ready_write)
+        self.workers[pid] = time.monotonic()
+        return pid, ready_read
+
+    def wait_ready(self, ready_fd: int, timeout: float) -> bool:
+        try:
+            readable, _, _ = select.select([ready_fd], [], [], timeout)
+            return bool(readable) and os.read(ready_fd, 1) == b'1'
+        finally:
+            os.close(ready_fd)
+
+    def stop_worker(self, pid: int, timeout: float):
+        # SIGTERM makes uvicorn stop accepting, finish in-flight requests, and run the lifespan shutdown
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    break
+                time.sleep(0.05)
+            else:
+                self._log(f'worker {pid} took too long to stop. killing it')
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass    # already reaped
+        self.workers.pop(pid, None)
+
+    def rolling_restart(self):
+        self._log('rolling restart')
+        for old_pid in list(self.workers):
+            if self.stopping:
+                return
+            new_pid, ready_fd = self.spawn()
+            if not self.wait_ready(ready_fd, self.args.boot_timeout):
+                # the new worker is broken (bad code, bad config...). keep the old ones running
+                self._log(f'worker {new_pid} did not start. rolling restart aborted')
+                self.stop_worker(new_pid, self.args.graceful_timeout)
+                return
+            self.stop_worker(old_pid, self.args.graceful_timeout)
+        self._log('rolling restart done')
+
+    def reap(self):
+        # replaces workers that died on their own
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            self._log(f'worker {pid} exited with status {status}. replacing it')
+            if time.monotonic() - started < 1:
+                time.sleep(1)   # it died right away. don't fork in a tight loop
+            self.spawn_ready()
+
+    def spawn_ready(self):
+        pid, ready_fd = self.spawn()
+        if not self.wait_ready(ready_fd, self.args.boot_timeout):
+            self._log(f'worker {pid} did not start in time')
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_hup(self, signum, frame):
+        self.reload_requested = True
+
+    def run(self):
+        if self.args.workers > 1:
+            shared_state = self.args.shared_state or _default_shared_state_path(self.args.port)
+            os.environ.setdefault('X_RATE_LIMIT_BACKEND', shared_state)
+            os.environ.setdefault('X_REVOCATION_BACKEND', shared_state)
+            # made here, in the master, so that every worker gets the same one - with or without preload
+            os.environ.setdefault('X_TOKEN_SECRET', secrets.token_hex(32))
+
+        self.socket = self._bind()
+        if self.args.preload:
+            uvicorn, _ = _import_uvicorn()
+            from uvicorn.importer import import_from_string
+            self.app = import_from_string(self.args.app)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_hup)
+
+        self._log(f'serving {self.args.app} on {self.args.host}:{self.args.port} with {self.args.workers} workers')
+        for _ in range(self.args.workers):
+            self.spawn_ready()
+
+        while not self.stopping:
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.rolling_restart()
+            time.sleep(0.5)
+
+        self._log('stopping')
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.workers):
+            self.stop_worker(pid, self.args.graceful_timeout)
+        self.socket.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-forking server for the apps in app/')
+    parser.add_argument('app', help="the app to serve, e.g. 'app.oauth_passlib_advanced:app'")
+    parser.add_argument('--host', default=os.environ.get('X_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('X_PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('X_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--no-preload', dest='preload', action='store_false', help='import the app in each worker')
+    parser.add_argument('--graceful-timeout', type=int, default=30, help='seconds a worker gets to finish its requests')
+    parser.add_argument('--boot-timeout', type=float, default=60, help='seconds a new worker gets to start up')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--shared-state', default=os.environ.get('X_SHARED_STATE_PATH'))
+    parser.add_argument('--access-log', action='store_true')
+    parser.add_argument('--proxy-headers', action='store_true', help='trust X-Forwarded-For etc. from the proxy')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    Master(parse_args()).run()
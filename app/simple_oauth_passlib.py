@@ -1,13 +1,34 @@
-from fastapi import FastAPI, HTTPException, Depends
+import os
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 from typing import Union, Annotated
 from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+
+from .journal_store import UsernameTaken
+from .storage import CachedJournals
+from .hashing import PasswordHasher, HasherBusy, hasher_busy_handler
+from .signed_tokens import TokenSigner
+from .metrics import install_metrics, registry
+from .compression import install_compression
+from .rate_limit import login_throttle, RateLimited, rate_limited_handler
+from .log import get_logger
+from .etags import version_etag, etag_matches, etag_headers, not_modified_response
+
+log = get_logger(__name__)
 
 pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+pwd_hasher = PasswordHasher(pwd_context)
 oauth2 = OAuth2PasswordBearer('access-token')
 
+# how access tokens are made and checked:
+#   'hmac'   - (default) a signed token, checked with an HMAC and cached once validated. see signed_tokens.py
+#   'bcrypt' - the original approach: the token is a bcrypt hash of get_hash_salt(), checked with a full bcrypt verify
+TOKEN_MODE = os.environ.get('X_TOKEN_MODE', 'hmac')
+token_signer = TokenSigner(os.environ.get('X_TOKEN_SECRET'), ttl=int(os.environ.get('X_TOKEN_TTL', 3600)))
+
 """
 Simple auth.
 """
@@ -18,25 +39,38 @@ class Journal(BaseModel):
     password: str  # hashed password. don't store raw passwords
     secrets: str
     email: EmailStr | None = None
-    __journals__: list['Journal'] = []
+    __journals__: CachedJournals    # backed by the 'journals' table. set up right below the class
 
     @classmethod
-    def add_to_db(cls, journal: 'Journal'):
-        # adds journal to database
-        journal.password = pwd_context.hash(journal.password)
-        print("Added new journal to db:", journal)
-        cls.__journals__.append(journal)
+    async def add_to_db(cls, journal: 'Journal'):
+        # adds journal to database. raises UsernameTaken if the username is taken
+        if journal.username in cls.__journals__:
+            raise UsernameTaken(journal.username)
+        journal.password = await pwd_hasher.hash(journal.password)
+        log.info('added new journal to db', journal=journal)     # password and secrets are redacted
+        cls.__journals__.add(journal)
 
     @classmethod
     def all(cls):
-        return cls.__journals__
+        return list(cls.__journals__)
 
     @classmethod
     def get(cls, username: str) -> Union['Journal', None]:
-        for journal in cls.__journals__:
-            if journal.username == username:
-                return journal
-        return None
+        # O(1) lookup by username. see journal_store.py for why this is still safe against timing attacks
+        return cls.__journals__.get(username)
+
+    @classmethod
+    def get_versioned(cls, username: str) -> tuple[int, Union['Journal', None]]:
+        # the journal, plus the version of the journals table it was read at. for the ETag. see etags.py
+        return cls.__journals__.get_versioned(username)
+
+    @classmethod
+    def update(cls, username: str, /, **changes) -> Union['Journal', None]:
+        return cls.__journals__.update(username, **changes)
+
+    @classmethod
+    def delete(cls, username: str) -> bool:
+        return cls.__journals__.delete(username)
 
     def get_hash_salt(self):
         # this method returns content that will be used to generate the access token.
@@ -44,93 +78,155 @@ class Journal(BaseModel):
         return self.username + "." + self.password
 
     @classmethod
-    def preload_journals_from_db_to_cache(cls):
-        # dummy function that simulates caching data from db
-        cls.add_to_db(Journal(username='foo', password='bar', secrets='i ate a cow'))
-        cls.add_to_db(Journal(username='john', password='doe', secrets='put some dough on his head'))
-        cls.add_to_db(Journal(username='jane', password='don', secrets='i pee while standing'))
-        cls.add_to_db(Journal(username='abc', password='123', secrets='im pretty good at math'))
+    async def preload_journals_from_db_to_cache(cls):
+        # seeds the db with a few journals the first time around, and then warms the cache with everything in the db
+        if cls.__journals__.count() == 0:
+            seeds = [
+                Journal(username='foo', password='bar', secrets='i ate a cow'),
+                Journal(username='john', password='doe', secrets='put some dough on his head'),
+                Journal(username='jane', password='don', secrets='i pee while standing'),
+                Journal(username='abc', password='123', secrets='im pretty good at math'),
+            ]
+            for journal in seeds:
+                journal.password = await pwd_hasher.hash(journal.password)
+            try:
+                cls.__journals__.add_many(seeds)    # one transaction for the lot
+            except UsernameTaken:
+                pass    # another worker seeded the db at the same time
+
+        cls.__journals__.load()
         cls.dump()
 
     @classmethod
     def dump(cls):
-        from pprint import pprint
-        pprint(cls.__journals__)
+        log.debug('journals in cache', journals=cls.all())
 
     @classmethod
     def clear_cache(cls):
-        del cls.__journals__
-        print("Cleared cache")
+        cls.__journals__.clear()
+        log.info('cleared cache')
+
+
+Journal.__journals__ = CachedJournals('journals', Journal)
+
+
+def journal_etag(version: int, username: str) -> str:
+    return version_etag(Journal.__journals__.db, 'j', version, username)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    Journal.preload_journals_from_db_to_cache()
+    # picks the bcrypt cost for this host (if X_BCRYPT_BUDGET_MS is set) before the seed journals get hashed
+    await pwd_hasher.calibrate()
+    await Journal.preload_journals_from_db_to_cache()
     yield
     Journal.clear_cache()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(HasherBusy, hasher_busy_handler)
+app.add_exception_handler(RateLimited, rate_limited_handler)
+install_compression(app, 'simple_oauth_passlib')
+install_metrics(app, 'simple_oauth_passlib')
+registry.register_stats('token_cache', token_signer.cache.stats)
+registry.register_stats('password_hasher', pwd_hasher.stats, {'app': 'simple_oauth_passlib'})
 
 
 @app.post('/journal', response_model_include={'username'})
-def add_journal(journal: Journal) -> Journal:
+async def add_journal(journal: Journal) -> Journal:
     # we don't need an access token for this operation because it is the entry point of the Journal, we're
     # not authorizing anything at this point.
-    Journal.add_to_db(journal)
+    try:
+        await Journal.add_to_db(journal)
+    except UsernameTaken:
+        raise HTTPException(status_code=409, detail='Journal already exists')
     return journal
 
 
 @app.post('/access-token')
-def get_access_token(creds: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def get_access_token(request: Request, creds: Annotated[OAuth2PasswordRequestForm, Depends()]):
     """
     For a client to access any of the protected path operations, they need an access token, which is generated
     from their username and password.
-    First, the code checks whether the username exists in the database. If not, a 404 exception is thrown.
+    Login attempts are throttled per client and per username (see rate_limit.py). Too many, and the client gets a 429
+    before any password hashing happens.
+    Then, the code checks whether the username exists in the database. If not, a 404 exception is thrown.
     Next, the client's password is verified against the hashed password stored in the db, if the journal exists.
-    If not verified, a 401 unauthorized error is thrown.
+    If not verified, a 401 unauthorized error is thrown. If verified, but the stored hash was made with an old bcrypt
+    cost, the password gets rehashed with the current one (and the token is made from the new hash).
 
-    Else, return the access token by hashing the combo of username and password (get_hash_salt())
+    Else, return the access token by signing the combo of username and password (or, in 'bcrypt' token mode, by hashing
+    get_hash_salt())
     :param creds: username and password
     :return: access token
     """
     username = creds.username
     password = creds.password
 
-    journal = Journal.get(username)
+    await login_throttle.check(request, username, scope='simple_oauth_passlib')
+
+    # the store calls are SQLite queries (and the update a write transaction), so they run in the threadpool
+    journal = await run_in_threadpool(Journal.get, username)
     if not journal:
         raise HTTPException(status_code=404, detail="You don't exist")
-    if not pwd_context.verify(password, journal.password):
+    verified, new_hash = await pwd_hasher.verify_and_update(password, journal.password)
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid password")
+    if new_hash is not None:
+        journal = await run_in_threadpool(Journal.update, username, password=new_hash)
+        log.info('rehashed password', username=username)
+
+    if TOKEN_MODE == 'bcrypt':
+        access_token = await pwd_hasher.hash(journal.get_hash_salt())
+    else:
+        access_token = token_signer.issue(journal.username, journal.password)
 
     return {
-        "access_token": pwd_context.hash(journal.get_hash_salt()),
+        "access_token": access_token,
         "token_type": "bearer"
     }
 
 
 @app.get('/journal/{username}', response_model_exclude={'password'})
-def get_journal(username: str, token: Annotated[str, Depends(oauth2)]) -> Journal:
+async def get_journal(request: Request, username: str, token: Annotated[str, Depends(oauth2)]) -> Journal:
     """
     This path op needs an access token.
     To access the journal, the user passes in their username. By this point, they already have the access token,
-    which is their hashed-together username and password.
+    which is their signed (or hashed) together username and password.
     Code checks if that username exists, if not it throws 404 error.
     Next, code verifies the access token. The raw version is just "username + . + hashed password". This is obtained from
     the Journal object. The raw is checked against the access token and if it's valid, it becomes verified.
+    In 'hmac' token mode, that check is an HMAC (and usually just a cache hit) instead of a bcrypt verify.
     If the token doesn't exist or is unverified, throw 401 Unauthorized error.
+    If the journal hasn't changed since the client's copy (If-None-Match), it gets a 304 with no body.
+    :param request: the request, for its If-None-Match header
     :param username: the user's name for the journal
     :param token: the access token
     :return:
     """
-    journal = Journal.get(username)
+    version, journal = await run_in_threadpool(Journal.get_versioned, username)
 
     if not journal:
         raise HTTPException(status_code=404, detail="You don't exist")
 
-    print("tok", token)
-    print("salt", journal.get_hash_salt())
-    if not token or not pwd_context.verify(journal.get_hash_salt(), token):
+    log.debug('verifying access token', username=username)
+    if TOKEN_MODE == 'bcrypt':
+        try:
+            verified = bool(token) and await pwd_hasher.verify(journal.get_hash_salt(), token)
+        except ValueError:  # not a bcrypt hash at all
+            verified = False
+    else:
+        verified = bool(token) and token_signer.verify(token, journal.username, journal.password)
+
+    if not verified:
         raise HTTPException(status_code=401, headers={'WWW-Authenticate': 'Bearer'})
 
-    return journal
+    # only checked once the token is, so the ETag can't be used to find out anything about the journal
+    etag = journal_etag(version, username)
+    if etag_matches(request, etag):
+        return not_modified_response(etag, private=True)
+    return Response(
+        journal.model_dump_json(exclude={'password'}),
+        media_type='application/json',
+        headers=etag_headers(etag, private=True)
+    )
@@ -0,0 +1,81 @@
+"""
+Cached, conditional serving of static files (like the login page).
+
+A StaticAsset reads its file once and keeps the bytes in memory. On each request it only stat()s the file: if the
+inode, mtime or size changed (the file was edited or replaced), the cached copy is reloaded.
+    - ETag and Last-Modified are derived from the stat result, so the body never needs hashing
+    - If-None-Match / If-Modified-Since are answered with 304 Not Modified
+    - files larger than `max_cached_size` aren't kept in memory at all. they're sent with FileStreamResponse, which
+      uses zero-copy sendfile when the server supports it
+"""
+
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+from .etags import etag_matches
+from .file_responses import FileStreamResponse
+
+STATIC_CACHE_MAX_BYTES = int(os.environ.get('X_STATIC_CACHE_MAX_BYTES', 1024 * 1024))
+
+
+def etag_for(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110 13.2.2)
+    if 'if-none-match' in request.headers:
+        return etag_matches(request, etag)
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+class StaticAsset:
+
+    def __init__(self, path: str, media_type: str, max_cached_size: int = STATIC_CACHE_MAX_BYTES):
+        self.path = path
+        self.media_type = media_type
+        self.max_cached_size = max_cached_size
+        self._lock = threading.Lock()
+        self._key = None
+        self._body: bytes | None = None
+
+    def _refresh(self) -> os.stat_result:
+        # raises FileNotFoundError if the file is gone
+        stat_result = os.stat(self.path)
+        key = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        if key != self._key:
+            with self._lock:
+                if key != self._key:
+                    body = None
+                    if stat_result.st_size <= self.max_cached_size:
+                        with open(self.path, 'rb') as file:
+                            body = file.read()
+                    self._body, self._key = body, key
+        return stat_result
+
+    def response(self, request: Request) -> Response:
+        stat_result = self._refresh()
+        etag = etag_for(stat_result)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+        }
+
+        if not_modified(request, etag, stat_result.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+        body = self._body
+        if body is None:
+            return FileStreamResponse(self.path, stat_result, headers=headers, media_type=self.media_type)
+        return Response(body, media_type=self.media_type, headers=headers)
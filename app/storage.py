@@ -0,0 +1,440 @@
+"""
+SQLite persistence for Journal and Recruit, with an in-process cache of the rows in front of it.
+
+Until now all state lived in class-level lists, so it disappeared on restart and every uvicorn worker had its own copy.
+Now the source of truth is a SQLite database:
+    - WAL mode, so readers don't block the writer (and vice versa), and several processes can share the file
+    - a small pool of connections, handed out per operation (sync path operations run in a threadpool)
+    - every statement is a fixed SQL string with ? placeholders. sqlite3 keeps compiled statements in a per-connection
+      cache keyed by the SQL text, so each statement is only prepared once per connection
+    - bulk inserts run as one transaction (add_many), instead of a commit per row
+
+Reads are served from an in-process cache (UsernameStore for journals, copy-on-write snapshots for recruits) which the
+app lifespan fills on startup. Every write bumps a per-table version number in the database, in the same transaction as
+the write. Before serving a read, the cache compares its version with the database's. If another worker has written in
+the meantime, the cache is refreshed. The same version numbers make the ETags of the read endpoints (see etags.py).
+
+So a cached read isn't free: it still costs one SQLite query, the version check (a primary key lookup in the tiny
+versions table, on a pooled connection). What the cache saves is fetching the rows and validating them into models,
+which is most of the work for anything but a single row. Skipping the version check too would mean serving another
+worker's stale data for a while, and the ETags would go stale with it.
+
+Config (environment variables):
+    X_DB_PATH       path of the SQLite database file. defaults to 2fast2furious.db in the working directory
+    X_DB_POOL_SIZE  max number of pooled connections. defaults to 4
+"""
+
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator
+
+from .journal_store import UsernameStore, UsernameTaken
+
+DB_PATH = os.environ.get('X_DB_PATH', '2fast2furious.db')
+DB_POOL_SIZE = int(os.environ.get('X_DB_POOL_SIZE', 4))
+
+
+class Database:
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._instance_id: str | None = None
+        self._reset()
+
+    def _reset(self):
+        self._pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._created = 0
+        self._pid = os.getpid()
+        self._schemas_created: set[str] = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None puts the connection in autocommit mode. transactions are started explicitly, below
+        conn = sqlite3.connect(
+            self.path, timeout=5.0, isolation_level=None, check_same_thread=False, cached_statements=256
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')   # safe with WAL, and a lot faster than FULL
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+        )
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            # we've been forked. connections can't be shared with the parent, so start a fresh pool
+            self._reset()
+
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.pool_size
+                if can_create:
+                    self._created += 1
+            conn = self._connect() if can_create else self._pool.get()
+
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue up instead of failing half way
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def create_schema(self, name: str, sql: str):
+        if name in self._schemas_created:
+            return
+        with self.connection() as conn:
+            conn.execute(sql)
+        self._schemas_created.add(name)
+
+    @contextmanager
+    def read_transaction(self) -> Iterator[sqlite3.Connection]:
+        # every read in it sees the database as it was at its first read, even if a writer commits in between (that's
+        # WAL's snapshot isolation). for reads that have to agree with each other, like a version and its rows
+        with self.connection() as conn:
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            finally:
+                conn.execute('COMMIT')
+
+    def version(self, name: str) -> int:
+        with self.connection() as conn:
+            return self.read_version(conn, name)
+
+    @staticmethod
+    def read_version(conn: sqlite3.Connection, name: str) -> int:
+        row = conn.execute('SELECT version FROM versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def instance_id(self) -> str:
+        # a random id, made the first time the database file is used and kept in it. the versions start over at 0 in a
+        # new file, and this keeps (say) version 3 of the old file apart from version 3 of the new one
+        if self._instance_id is None:
+            with self.transaction() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                conn.execute(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES ('instance_id', ?)", (secrets.token_hex(8),)
+                )
+                self._instance_id = conn.execute("SELECT value FROM meta WHERE key = 'instance_id'").fetchone()[0]
+        return self._instance_id
+
+    @staticmethod
+    def bump_version(conn: sqlite3.Connection, name: str) -> int:
+        # must be called inside a transaction. returns the version number from *before* the bump
+        previous = Database.read_version(conn, name)
+        conn.execute(
+            'INSERT INTO versions (name, version) VALUES (?, 1) '
+            'ON CONFLICT(name) DO UPDATE SET version = version + 1',
+            (name,)
+        )
+        return previous
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+
+database = Database()
+
+
+class CachedJournals:
+    """
+    Journals, stored in a SQLite table and cached in a UsernameStore. Same interface as UsernameStore, so Journal's
+    classmethods don't need to know the difference.
+    """
+
+    def __init__(self, table: str, model: type, db: Database = database):
+        self.table = table
+        self.model = model
+        self.db = db
+        self.cache = UsernameStore()
+        self._version = -1
+
+        # the table name comes from our own code, never from a request, so it's fine to format it in
+        self._create_sql = (
+            f'CREATE TABLE IF NOT EXISTS {table} '
+            f'(username TEXT PRIMARY KEY, password TEXT NOT NULL, secrets TEXT NOT NULL, email TEXT)'
+        )
+        self._insert_sql = f'INSERT INTO {table} (username, password, secrets, email) VALUES (?, ?, ?, ?)'
+        self._select_sql = f'SELECT username, password, secrets, email FROM {table} WHERE username = ?'
+        self._select_all_sql = f'SELECT username, password, secrets, email FROM {table}'
+        self._update_sql = f'UPDATE {table} SET username = ?, password = ?, secrets = ?, email = ? WHERE username = ?'
+        self._delete_sql = f'DELETE FROM {table} WHERE username = ?'
+
+    def _row(self, journal) -> tuple:
+        return journal.username, journal.password, journal.secrets, journal.email
+
+    def _journal(self, row: tuple):
+        username, password, secrets, email = row
+        return self.model(username=username, password=password, secrets=secrets, email=email)
+
+    def _schema(self):
+        self.db.create_schema(self.table, self._create_sql)
+
+    def _sync(self):
+        # drop the cache if anyone else has written to the table since we last looked. one version query per read
+        self._schema()
+        version = self.db.version(self.table)
+        if version != self._version:
+            self.cache.clear()
+            self._version = version
+
+    def _wrote(self, previous_version: int):
+        # our own writes keep the cache in sync, so they shouldn't invalidate it. someone else's write in between
+        # would, which is why we only move along if the version was the one we knew about
+        if previous_version == self._version:
+            self._version = previous_version + 1
+
+    def load(self):
+        # warms the cache with every journal in the table
+        self._sync()
+        with self.db.connection() as conn:
+            rows = conn.execute(self._select_all_sql).fetchall()
+        for row in rows:
+            self.cache.put(self._journal(row))
+
+    def add(self, journal):
+        self.add_many([journal])
+
+    def add_many(self, journals: list):
+        self._sync()
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany(self._insert_sql, [self._row(journal) for journal in journals])
+                previous = self.db.bump_version(conn, self.table)
+        except sqlite3.IntegrityError:
+            raise UsernameTaken(', '.join(journal.username for journal in journals))
+        self._wrote(previous)
+        for journal in journals:
+            self.cache.put(journal)
+
+    def get(self, username: str):
+        self._sync()
+        return self._get(username)
+
+    def get_versioned(self, username: str) -> tuple[int, object]:
+        # the journal, and the version of the table it was read at. the version is read first, so the journal is never
+        # older than the version says (at worst newer, which only costs a client one 200 instead of a 304)
+        self._sync()
+        return self._version, self._get(username)
+
+    def _get(self, username: str):
+        journal = self.cache.get(username)
+        if journal is None:
+            # read-through: fetch it from the db and remember it
+            with self.db.connection() as conn:
+                row = conn.execute(self._select_sql, (username,)).fetchone()
+            if row is not None:
+                journal = self._journal(row)
+                self.cache.put(journal)
+        return journal
+
+    def update(self, username: str, /, **changes):
+        journal = self.get(username)
+        if journal is None:
+            return None
+
+        # validated like a new journal would be, so the db never holds a row that won't load back
+        updated = self.model.model_validate({**journal.model_dump(), **changes})
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(self._update_sql, (*self._row(updated), username))
+                previous = self.db.bump_version(conn, self.table)
+        except sqlite3.IntegrityError:
+            raise UsernameTaken(updated.username)
+        self._wrote(previous)
+        return self.cache.update(username, **{field: getattr(updated, field) for field in changes})
+
+    def delete(self, username: str) -> bool:
+        self._sync()
+        with self.db.transaction() as conn:
+            deleted = conn.execute(self._delete_sql, (username,)).rowcount > 0
+            previous = self.db.bump_version(conn, self.table)
+        self._wrote(previous)
+        self.cache.delete(username)
+        return deleted
+
+    def count(self) -> int:
+        self._schema()
+        with self.db.connection() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def clear(self):
+        # only clears the cache. the journals are still in the db
+        self.cache.clear()
+        self._version = -1
+
+    def __contains__(self, username: str) -> bool:
+        return self.get(username) is not None
+
+    def __iter__(self) -> Iterator:
+        # the cache might only hold some of the journals (read-through), so iterate over the table itself
+        self._schema()
+        with self.db.connection() as conn:
+            rows = conn.execute(self._select_all_sql).fetchall()
+        for row in rows:
+            yield self.cache.get(row[0]) or self._journal(row)
+
+    def __len__(self) -> int:
+        return self.count()
+
+
+class RecruitSnapshot:
+    """
+    An immutable view of every recruit at one version of the table. Recruits are kept in id order, and ids are the
+    table's primary keys, so they stay the same whatever else is added.
+    """
+
+    __slots__ = ('version', 'ids', 'recruits')
+
+    def __init__(self, version: int, ids: tuple[int, ...], recruits: tuple):
+        self.version = version
+        self.ids = ids
+        self.recruits = recruits
+
+    def get(self, member_id: int):
+        # ids are sorted, so this is a binary search
+        position = bisect_left(self.ids, member_id)
+        if position < len(self.ids) and self.ids[position] == member_id:
+            return self.recruits[position]
+        return None
+
+    def __iter__(self) -> Iterator:
+        return iter(self.recruits)
+
+    def __len__(self) -> int:
+        return len(self.recruits)
+
+
+class CachedRecruits:
+    """
+    Recruits, stored as JSON documents in a SQLite table and cached in memory, in id order.
+
+    Sync endpoints run in a threadpool, so reads and writes happen concurrently. Readers never lock anything: they grab
+    the current RecruitSnapshot and iterate over it as long as they like. Writers take a lock (one writer at a time),
+    write to the db, and then publish a *new* snapshot with the change applied - copy-on-write. A snapshot is never
+    modified once published, so a reader can't see half of a write. Recruits are never modified in place either: an
+    update replaces the recruit with an updated copy.
+
+    Copying the tuple makes each write O(n), but that's a pointer copy, and add_many does it once per batch.
+    """
+
+    TABLE = 'recruits'
+    CREATE_SQL = f'CREATE TABLE IF NOT EXISTS {TABLE} (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)'
+    INSERT_SQL = f'INSERT INTO {TABLE} (data) VALUES (?)'
+    SELECT_ALL_SQL = f'SELECT id, data FROM {TABLE} ORDER BY id'
+    UPDATE_SQL = f'UPDATE {TABLE} SET data = ? WHERE id = ?'
+
+    def __init__(self, model: type, db: Database = database):
+        self.model = model
+        self.db = db
+        self._snapshot = RecruitSnapshot(-1, (), ())
+        self._write_lock = threading.Lock()
+
+    def snapshot(self) -> RecruitSnapshot:
+        # the current snapshot, refreshed first if another worker has written to the table. that check is a query,
+        # on every call (see the top of this file)
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        snapshot = self._snapshot
+        if self.db.version(self.TABLE) != snapshot.version:
+            with self._write_lock:
+                self._load()
+            snapshot = self._snapshot
+        return snapshot
+
+    def _load(self):
+        # must be called with the write lock held. the version and the rows are read in one transaction, so that a
+        # write landing in between can't label the old rows with its new version
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self.db.read_transaction() as conn:
+            version = self.db.read_version(conn, self.TABLE)
+            rows = conn.execute(self.SELECT_ALL_SQL).fetchall()
+        self._snapshot = RecruitSnapshot(
+            version, tuple(row[0] for row in rows), tuple(self.model.model_validate_json(row[1]) for row in rows)
+        )
+
+    def load(self):
+        # (re)fills the cache with every recruit in the table
+        with self._write_lock:
+            self._load()
+
+    def add(self, recruit) -> int:
+        return self.add_many([recruit])[0]
+
+    def add_many(self, recruits: list) -> list[int]:
+        # returns the ids of the new recruits
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self._write_lock:
+            with self.db.transaction() as conn:
+                ids = [conn.execute(self.INSERT_SQL, (recruit.model_dump_json(),)).lastrowid for recruit in recruits]
+                previous = self.db.bump_version(conn, self.TABLE)
+
+            current = self._snapshot
+            if previous == current.version:
+                self._snapshot = RecruitSnapshot(
+                    previous + 1, current.ids + tuple(ids), current.recruits + tuple(recruits)
+                )
+            else:
+                self._load()    # someone else wrote in between. start over from the db
+        return ids
+
+    def update(self, member_id: int, /, **changes):
+        # returns the updated recruit, or None if there's no recruit with that id
+        self.db.create_schema(self.TABLE, self.CREATE_SQL)
+        with self._write_lock:
+            if self.db.version(self.TABLE) != self._snapshot.version:
+                self._load()
+            current = self._snapshot
+            recruit = current.get(member_id)
+            if recruit is None:
+                return None
+
+            # validated like a new hire, so the db never holds a row that _load can't read back
+            updated = self.model.model_validate({**recruit.model_dump(), **changes})
+            with self.db.transaction() as conn:
+                conn.execute(self.UPDATE_SQL, (updated.model_dump_json(), member_id))
+                previous = self.db.bump_version(conn, self.TABLE)
+
+            if previous == current.version:
+                position = bisect_left(current.ids, member_id)
+                recruits = current.recruits[:position] + (updated,) + current.recruits[position + 1:]
+                self._snapshot = RecruitSnapshot(previous + 1, current.ids, recruits)
+            else:
+                self._load()
+        return updated
+
+    def get(self, member_id: int):
+        return self.snapshot().get(member_id)
+
+    def all(self) -> tuple:
+        return self.snapshot().recruits
+
+    def clear(self):
+        with self._write_lock:
+            self._snapshot = RecruitSnapshot(-1, (), ())
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
@@ -0,0 +1,219 @@
+"""
+Latency/throughput benchmarks for every app in app/.
+
+Each scenario (see scenarios.py) is fired --requests times, by --concurrency concurrent clients, and we report
+requests per second and p50/p95/p99 latency. By default the apps run in-process, through httpx's ASGI transport (no
+sockets, so the numbers are the app's own cost). With --uvicorn, each app is started in a local uvicorn process and
+hit over HTTP instead.
+
+Results can be saved as a JSON baseline, and later runs compared against it:
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json --threshold 0.15
+
+In compare mode, the exit status is 1 if any scenario got slower than the threshold allows: p95 latency up by more
+than the threshold, or RPS down by more than it.
+
+Examples:
+    python -m benchmarks.run --apps main,dough --requests 2000 --concurrency 32
+    python -m benchmarks.run --scenarios token_issue,authenticated_read
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+# the apps read these at import time. a throwaway database keeps benchmark data out of the real one
+os.environ.setdefault('X_API_KEY', 'benchmark-only-not-a-secret-benchmark-only-not-a-secret')
+os.environ.setdefault('X_API_KEY_ALGO', 'HS256')
+os.environ.setdefault('X_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='2f2f-bench-'), 'bench.db'))
+# every request comes from the same client, so login throttling would turn the token scenarios into 429 benchmarks
+os.environ.setdefault('X_LOGIN_RATE_IP', '0')
+os.environ.setdefault('X_LOGIN_RATE_USER', '0')
+
+import httpx
+
+from .scenarios import BENCHMARKS, AppBenchmark, Scenario
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+@asynccontextmanager
+async def in_process_client(module_name: str):
+    app = importlib.import_module(module_name).app
+    # the ASGI transport doesn't run lifespan events, so run the app's lifespan ourselves
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            yield client
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def uvicorn_client(module_name: str):
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', f'{module_name}:app', '--port', str(port), '--log-level', 'warning'],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        async with httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=256)) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    await client.get('/docs')
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline or server.poll() is not None:
+                        raise RuntimeError(f"uvicorn didn't start {module_name}")
+                    await asyncio.sleep(0.1)
+            yield client
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int) -> dict:
+    state = await scenario.setup(client)
+    total = max(1, int(requests * scenario.weight))
+
+    for _ in range(min(10, total)):     # warm up caches, connections, lazy initialisation
+        await scenario.request(client, state)
+
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await scenario.request(client, state)
+                if response.status_code >= 500:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': total,
+        'errors': errors,
+        'rps': total / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+async def run_app(benchmark: AppBenchmark, args) -> dict:
+    results = {}
+    client_factory = uvicorn_client if args.uvicorn else in_process_client
+    scenarios = [s for s in benchmark.scenarios if not args.scenarios or s.name in args.scenarios]
+    if not scenarios:
+        return results
+
+    async with client_factory(benchmark.module) as client:
+        for scenario in scenarios:
+            key = f'{benchmark.module}:{scenario.name}'
+            results[key] = await run_scenario(client, scenario, args.requests, args.concurrency)
+            print_result(key, results[key])
+    return results
+
+
+def print_result(key: str, result: dict):
+    print(
+        f"{key:<60} {result['rps']:>10.1f} rps  "
+        f"p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  "
+        f"errors {result['errors']}",
+        file=sys.stderr
+    )
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # returns a description of every regression beyond the threshold
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append(f"{key}: p95 {base['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"{key}: rps {base['rps']:.1f} -> {result['rps']:.1f}")
+    return regressions
+
+
+async def main(args) -> int:
+    benchmarks = [b for b in BENCHMARKS if not args.apps or b.module.rsplit('.', 1)[-1] in args.apps]
+    results = {}
+    for benchmark in benchmarks:
+        results.update(await run_app(benchmark, args))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': 'uvicorn' if args.uvicorn else 'asgi',
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--apps', type=lambda s: s.split(','), help='comma-separated app modules, e.g. main,dough')
+    parser.add_argument('--scenarios', type=lambda s: s.split(','), help='comma-separated scenario names')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario (before weighting)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--uvicorn', action='store_true', help='run each app in a local uvicorn process')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against a baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed regression, as a fraction')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,170 @@
+"""
+Benchmark scenarios, one set per app module.
+
+A scenario is a named request that gets fired over and over. `setup` runs once before the timed runs, with the same
+client, and whatever it returns is passed to `request` - e.g. an access token.
+"""
+
+import secrets
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+Request = Callable[[httpx.AsyncClient, Any], Awaitable[httpx.Response]]
+Setup = Callable[[httpx.AsyncClient], Awaitable[Any]]
+
+
+async def _no_setup(client: httpx.AsyncClient):
+    return None
+
+
+@dataclass
+class Scenario:
+    name: str
+    request: Request
+    setup: Setup = _no_setup
+    # fraction of --requests to run. bcrypt-bound scenarios run fewer requests so that a full run stays quick
+    weight: float = 1.0
+
+
+@dataclass
+class AppBenchmark:
+    module: str     # e.g. 'app.main'. the ASGI app is the module's `app`
+    scenarios: list[Scenario]
+
+
+async def _journal_user(client: httpx.AsyncClient) -> tuple[str, str]:
+    # a fresh journal for each run, so that runs don't trip over each other's users
+    username, password = f'bench-{secrets.token_hex(4)}', 'bench-password'
+    response = await client.post('/journal', json={'username': username, 'password': password, 'secrets': 'shh'})
+    response.raise_for_status()
+    return username, password
+
+
+# main.py
+
+HIRE_URL = '/team/hire/tgc?experience-yrs=15&experiences=excel&experiences=cloud'
+HIRE_BODY = {'member': {'name': 'bench', 'email': 'bench@example.com', 'linked_in': 'https://example.com'}}
+
+
+async def _hire(client, _):
+    return await client.post(HIRE_URL, json=HIRE_BODY)
+
+
+async def _recruits(client, _):
+    return await client.get('/team/recruits')
+
+
+async def _ceo(client, _):
+    return await client.get('/team/ceo')
+
+
+async def _error_page(client, _):
+    return await client.get('/search', params={'query': 'nothing'})
+
+
+async def _security_error_page(client, _):
+    return await client.post(
+        '/login', headers={'X-Sec-Token': 'wrong', 'X-Sec-Key': 'wrong'}, data={'username': 'u', 'password': 'p'}
+    )
+
+
+async def _login_page(client, _):
+    return await client.get('/team/log-in')
+
+
+async def _xml(client, _):
+    return await client.get('/xml')
+
+
+# oauth_passlib_advanced.py & simple_oauth_passlib.py
+
+async def _form_token_setup(client):
+    username, password = await _journal_user(client)
+    token = (await client.post('/access-token', data={'username': username, 'password': password})).json()
+    return username, password, token['access_token']
+
+
+async def _form_token_issue(client, state):
+    username, password, _ = state
+    return await client.post('/access-token', data={'username': username, 'password': password})
+
+
+async def _bearer_journal(client, state):
+    return await client.get('/journal', headers={'Authorization': f'Bearer {state[2]}'})
+
+
+async def _bearer_journal_by_name(client, state):
+    return await client.get(f'/journal/{state[0]}', headers={'Authorization': f'Bearer {state[2]}'})
+
+
+# oauth_passlib_advanced_with_basic_auth.py
+
+async def _basic_token_setup(client):
+    username, password = await _journal_user(client)
+    token = (await client.get('/login', auth=(username, password))).json()
+    return username, password, token['access_token']
+
+
+async def _basic_token_issue(client, state):
+    return await client.get('/login', auth=(state[0], state[1]))
+
+
+# basic_auth.py
+
+async def _basic_user(client, _):
+    return await client.get('/user', auth=('foo', 'bar'))
+
+
+# dough.py
+
+async def _dough_token_issue(client, _):
+    return await client.post('/gen-token', data={'username': 'admin', 'password': 'strong123'})
+
+
+async def _dough_user(client, _):
+    return await client.get('/user/34', headers={'Authorization': 'Bearer adminstrong123'})
+
+
+# more.py
+
+async def _dining_balance(client, _):
+    return await client.get(
+        '/dining-dollars/2024-01-01', params={'name': 'bench', 'email': 'bench@example.com', 'password': 'p', 'token': 't'}
+    )
+
+
+BENCHMARKS = [
+    AppBenchmark('app.main', [
+        Scenario('ceo', _ceo),
+        Scenario('hire', _hire),
+        Scenario('recruits', _recruits),
+        Scenario('error_page', _error_page),
+        Scenario('security_error_page', _security_error_page),
+        Scenario('login_page', _login_page),
+        Scenario('xml', _xml),
+    ]),
+    AppBenchmark('app.oauth_passlib_advanced', [
+        Scenario('token_issue', _form_token_issue, _form_token_setup, weight=0.1),
+        Scenario('authenticated_read', _bearer_journal, _form_token_setup),
+    ]),
+    AppBenchmark('app.oauth_passlib_advanced_with_basic_auth', [
+        Scenario('token_issue', _basic_token_issue, _basic_token_setup, weight=0.1),
+        Scenario('authenticated_read', _bearer_journal, _basic_token_setup),
+    ]),
+    AppBenchmark('app.simple_oauth_passlib', [
+        Scenario('token_issue', _form_token_issue, _form_token_setup, weight=0.1),
+        Scenario('authenticated_read', _bearer_journal_by_name, _form_token_setup),
+    ]),
+    AppBenchmark('app.basic_auth', [
+        Scenario('user', _basic_user),
+    ]),
+    AppBenchmark('app.dough', [
+        Scenario('token_issue', _dough_token_issue),
+        Scenario('authenticated_read', _dough_user),
+    ]),
+    AppBenchmark('app.more', [
+        Scenario('dining_balance', _dining_balance),
+    ]),
+]
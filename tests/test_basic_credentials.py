@@ -0,0 +1,62 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from pydantic import BaseModel
+
+from app import basic_credentials
+from app.basic_credentials import BasicAuthVerifier, password_admin_router
+from app.hashing import PasswordHasher
+
+
+class User(BaseModel):
+    username: str
+    password: str
+
+
+def make_verifier() -> tuple[BasicAuthVerifier, dict[str, User]]:
+    hasher = PasswordHasher(CryptContext(schemes=['bcrypt'], bcrypt__rounds=4))
+    users = {
+        username: User(username=username, password=asyncio.run(hasher.hash(password)))
+        for username, password in (('foo', 'bar'), ('baz', 'qux'))
+    }
+
+    def store(username: str, new_hash: str):
+        users[username].password = new_hash
+
+    return BasicAuthVerifier(hasher, users.get, store), users
+
+
+def test_mass_password_change_invalidates_cached_credentials(monkeypatch):
+    monkeypatch.setattr(basic_credentials, 'ADMIN_KEY', 'admin')
+    verifier, users = make_verifier()
+    app = FastAPI()
+    app.include_router(password_admin_router(verifier, verifier.rehash))
+    client = TestClient(app)
+
+    for username, password in (('foo', 'bar'), ('baz', 'qux')):
+        assert asyncio.run(verifier.verify(username, password)) is not None
+        assert verifier.cached(username, password) is not None
+
+    assert client.put('/admin/passwords', json={'foo': 'new'}).status_code == 403
+    response = client.put('/admin/passwords', json={'foo': 'new', 'nobody': 'x'}, headers={'X-Admin-Key': 'admin'})
+    assert response.status_code == 200
+    assert response.json() == {'changed': ['foo']}
+
+    # baz's password didn't change, so only the invalidation can make it miss
+    assert verifier.cached('baz', 'qux') is None
+    assert verifier.cached('foo', 'bar') is None
+    assert asyncio.run(verifier.verify('foo', 'bar')) is None
+    assert asyncio.run(verifier.verify('foo', 'new')) is not None
+    assert asyncio.run(verifier.verify('baz', 'qux')) is not None
+
+
+def test_admin_route_is_off_without_admin_key(monkeypatch):
+    monkeypatch.setattr(basic_credentials, 'ADMIN_KEY', None)
+    verifier, _ = make_verifier()
+    app = FastAPI()
+    app.include_router(password_admin_router(verifier, verifier.rehash))
+
+    response = TestClient(app).put('/admin/passwords', json={'foo': 'new'}, headers={'X-Admin-Key': 'anything'})
+    assert response.status_code == 404
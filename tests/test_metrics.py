@@ -0,0 +1,41 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.metrics import install_metrics, registry
+
+
+def make_app(name: str) -> FastAPI:
+    app = FastAPI()
+    install_metrics(app, name)
+
+    @app.get('/journal/{username}')
+    def get_journal(username: str):
+        return {'username': username}
+
+    return app
+
+
+def count_lines(app_name: str, route: str) -> list[str]:
+    return [
+        line for line in registry.render().splitlines()
+        if line.startswith('http_requests_total{') and f'app="{app_name}"' in line and f'route="{route}"' in line
+    ]
+
+
+def test_metrics_route_gets_its_own_label():
+    client = TestClient(make_app('test_metrics_route'))
+    client.get('/metrics')
+    client.get('/metrics')
+
+    assert count_lines('test_metrics_route', '/metrics')
+    assert not count_lines('test_metrics_route', '<unmatched>')
+
+
+def test_api_routes_are_labelled_by_template():
+    client = TestClient(make_app('test_api_routes'))
+    client.get('/journal/foo')
+    client.get('/nope')
+
+    assert count_lines('test_api_routes', '/journal/{username}')
+    assert not count_lines('test_api_routes', '/journal/foo')
+    assert count_lines('test_api_routes', '<unmatched>')